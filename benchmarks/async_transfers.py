@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Thread engine (GFile) vs async engine (AsyncGFile) at 10, 100 and 1000 concurrent downloads.
+
+The thread engine runs one GFile per transfer on a thread pool, the way
+`download --jobs N` does; the async engine runs one AsyncGFile per transfer
+on a single event loop over a shared aiohttp connector, like `--async`. Each
+mode and concurrency runs in a fresh process, which downloads N files at
+once from a local aiohttp server in another process, and reports wall time,
+client CPU time, peak RSS and peak thread count. The pages are not fetched:
+the file lists are set directly, so only the transfers are measured.
+
+    python benchmarks/async_transfers.py [file size, e.g. 256K] [concurrency, e.g. 10,100,1000]
+
+Needs aiohttp.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiohttp
+from aiohttp import web
+
+from gigafilecli import AsyncGFile, GFile, bytes_to_size_str, size_str_to_bytes
+
+
+def serve(port):
+    bodies = {}
+
+    async def download(request):
+        # the file id is its size
+        size = int(request.query['file'])
+        data = bodies.setdefault(size, os.urandom(size))
+        if 'Range' in request.headers:
+            start, _, end = request.headers['Range'][6:].partition('-')
+            start, stop = int(start), int(end) + 1 if end else size
+            return web.Response(status=206, body=data[start:stop], headers={'Content-Range': f'bytes {start}-{stop - 1}/{size}'})
+        return web.Response(body=data)
+
+    app = web.Application()
+    app.router.add_get('/download.php', download)
+    print('ready', flush=True)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None, backlog=4096)
+
+
+def page(port, n):
+    return f'http://127.0.0.1:{port}/bench{n}'
+
+
+def run_threads(port, count, size, out):
+    def one(n):
+        gfile = GFile(page(port, n), progress=False, mute=True)
+        gfile.files = [(f'{n}.bin', '', str(size))]
+        return gfile.download(odir=out)
+
+    with ThreadPoolExecutor(max_workers=count) as ex:
+        return sum(bool(result) for result in ex.map(one, range(count)))
+
+
+def run_async(port, count, size, out):
+    async def main():
+        connector = aiohttp.TCPConnector(limit=count, limit_per_host=0)
+
+        async def one(n):
+            async with AsyncGFile(page(port, n), connector, mute=True) as gfile:
+                gfile.files = [(f'{n}.bin', '', str(size))]
+                return await gfile.download(odir=out)
+
+        try:
+            return sum(bool(result) for result in await asyncio.gather(*(one(n) for n in range(count))))
+        finally:
+            await connector.close()
+
+    return asyncio.run(main())
+
+
+def measure(mode, port, count, size):
+    threads = [threading.active_count()]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(0.01):
+            threads.append(threading.active_count())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    with tempfile.TemporaryDirectory() as out, contextlib.redirect_stdout(open(os.devnull, 'w')):
+        started = time.perf_counter()
+        cpu = time.process_time()
+        done = (run_threads if mode == 'threads' else run_async)(port, count, size, out)
+        cpu = time.process_time() - cpu
+        elapsed = time.perf_counter() - started
+    stop.set()
+    sampler.join()
+    # the sampler itself is not counted
+    print(json.dumps({'done': done, 'wall': elapsed, 'cpu': cpu, 'threads': max(threads) - 1,
+                      'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}))
+
+
+def main():
+    size = size_str_to_bytes(sys.argv[1] if len(sys.argv) > 1 else '256K')
+    counts = [int(n) for n in (sys.argv[2] if len(sys.argv) > 2 else '10,100,1000').split(',')]
+    port = 18000 + os.getpid() % 1000
+    server = subprocess.Popen([sys.executable, __file__, '--serve', str(port)], stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        print(f'{bytes_to_size_str(size)} per transfer')
+        for count in counts:
+            for mode in ('threads', 'async'):
+                result = subprocess.run([sys.executable, __file__, '--run', mode, str(port), str(count), str(size)],
+                                        capture_output=True, text=True, check=True)
+                r = json.loads(result.stdout.splitlines()[-1])
+                print(f'{count:>5} {mode:>7}: {r["done"]}/{count} done in {r["wall"]:.2f}s, {r["cpu"]:.2f} CPU s, '
+                      f'{count / r["wall"]:.0f} transfers/s, peak {bytes_to_size_str(r["rss"])} RSS, {r["threads"]} threads')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(int(sys.argv[2]))
+    elif sys.argv[1:2] == ['--run']:
+        measure(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        main()
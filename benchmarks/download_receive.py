@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""CPU seconds per GB downloaded, old iter_content loop vs GFile._receive.
+
+The old loop took a new bytes object from iter_content for every chunk and
+reported progress (lock, percentage, callback) after each one. _receive reads
+into one reusable buffer with iter_body and reports progress in batches. Both
+download the same file from a local http.server running in a subprocess, so
+only the client's CPU time is counted, and write it with a DownloadSink.
+
+    python benchmarks/download_receive.py [size, e.g. 1G] [chunk size, e.g. 1M]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gigafilecli import (DOWNLOAD_LIMITER, DownloadSink, DownloadState, GFile, RetryPolicy, bytes_to_size_str,
+                         size_str_to_bytes)
+
+
+def old_receive(gfile, url, state, sink):
+    with gfile._get(url, None) as r:
+        pos = 0
+        for chunk in r.iter_content(chunk_size=gfile.chunk_copy_size):
+            chunk = memoryview(chunk)
+            n = len(chunk)
+            DOWNLOAD_LIMITER.consume(n)
+            sink.write(pos, chunk)
+            pos += n
+            gfile._advance(state, n)
+
+
+def new_receive(gfile, url, state, sink):
+    gfile._receive(url, state, sink, [0, state.size])
+
+
+def run(name, func, url, size, chunk_size, out):
+    gfile = GFile(url, progress=False, chunk_copy_size=chunk_size, progress_callback=lambda *args, **kwargs: True)
+    gfile.retry = RetryPolicy()
+    state = DownloadState('bench.bin', out)
+    state.size = size
+    with DownloadSink(out, size) as sink:
+        started = time.perf_counter()
+        cpu = time.process_time()
+        func(gfile, url, state, sink)
+        cpu = time.process_time() - cpu
+        elapsed = time.perf_counter() - started
+    assert state.done == size, (state.done, size)
+    print(f'{name:>4}: {cpu / (size / 1e9):.3f} CPU s/GB, {bytes_to_size_str(size / elapsed)}/s')
+
+
+def main():
+    size = size_str_to_bytes(sys.argv[1] if len(sys.argv) > 1 else '1G')
+    chunk_size = size_str_to_bytes(sys.argv[2] if len(sys.argv) > 2 else '1M')
+    with tempfile.TemporaryDirectory() as tmp:
+        served = os.path.join(tmp, 'served')
+        os.mkdir(served)
+        with open(os.path.join(served, 'bench.bin'), 'wb') as f:
+            # sparse: served as zeros without writing them first
+            f.truncate(size)
+        server = subprocess.Popen([sys.executable, '-m', 'http.server', '--bind', '127.0.0.1', '0'],
+                                  cwd=served, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            # "Serving HTTP on 127.0.0.1 port 12345 (http://127.0.0.1:12345/) ..."
+            port = server.stdout.readline().split(' port ')[1].split()[0]
+            url = f'http://127.0.0.1:{port}/bench.bin'
+            print(f'{bytes_to_size_str(size)} in chunks of {bytes_to_size_str(chunk_size)}')
+            for name, func in (('old', old_receive), ('new', new_receive)):
+                out = os.path.join(tmp, name)
+                run(name, func, url, size, chunk_size, out)
+                os.remove(out)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Time and memory per download page, BeautifulSoup vs parse_download_page.
+
+GFile.resolve used to build a full BeautifulSoup(html.parser) tree of every
+page just to read #dl and .dl_size, or the .matomete_file entries.
+parse_download_page reads the same fields with regular expressions and stops
+at the name and size of a single file page; the BeautifulSoup parse is only
+used when it doesn't recognise the page. The fixtures are generated to look
+like the site's pages: a long head with inline scripts and styles, the
+download panel, and a footer.
+
+    python benchmarks/page_parse.py [rounds, e.g. 200] [files on the matomete page]
+"""
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gigafilecli import GFile, bytes_to_size_str, parse_download_page
+
+HEAD = ''.join(
+    f'<meta name="meta{i}" content="GigaFile便 無料大容量ファイル転送サービス {i}">\n'
+    f'<link rel="stylesheet" href="/css/style{i}.css?v=20240101">\n'
+    for i in range(20)
+) + '<style>.matomete_file { display: flex; } #dl { font-weight: bold; }</style>\n' + ''.join(
+    f'<script>window.cfg{i} = {{"panel": "<div id=\\"dl\\">", "n": {i}, "url": "https://example.com/?a=1&b=2"}};</script>\n'
+    for i in range(30)
+)
+
+NAV = ''.join(f'<li class="nav_item"><a href="/page{i}.html" title="メニュー {i}">メニュー {i}</a></li>\n' for i in range(40))
+
+FOOTER = ''.join(f'<p class="footer_note">注意事項 {i}: ファイルの保存期限を過ぎると削除されます。</p>\n' for i in range(60))
+
+
+def page(body):
+    return (f'<!DOCTYPE html>\n<html lang="ja">\n<head>\n{HEAD}</head>\n<body>\n'
+            f'<header><ul class="nav">\n{NAV}</ul></header>\n'
+            f'<main>\n{body}</main>\n<footer>\n{FOOTER}</footer>\n</body>\n</html>\n')
+
+
+def single_page():
+    return page('<div class="download_panel">\n'
+                '<div class="file_info"><p class="dl_size">1.23 GB</p>\n'
+                '<p id="dl" class="file_info_filename">report &amp; data 2024.zip</p></div>\n'
+                '<button class="download_panel_btn_dl" onclick="download(0, \'\')">ダウンロード開始</button>\n'
+                '</div>\n')
+
+
+def matomete_page(files):
+    return page('<div id="contents_matomete">\n' + ''.join(
+        f'<div class="matomete_file">\n'
+        f'<div class="matomete_file_info"><span class="icon"><img src="/img/file.png" alt=""></span>'
+        f'<span>photo_{i:04d}.jpg</span><span>（{i % 900 + 10} KB）</span></div>\n'
+        f'<button class="download_panel_btn_dl" onclick="download({i}, \'0101-{i:04d}-abcdef\')">DL</button>\n'
+        f'</div>\n'
+        for i in range(files)
+    ) + '</div>\n')
+
+
+def soup_parse(gfile, text):
+    files = gfile._parse_page_soup(text, '0101-abcdef')
+    return gfile.matomete, files
+
+
+def fast_parse(gfile, text):
+    return parse_download_page(text, '0101-abcdef')
+
+
+def run(name, func, fixture, text, rounds):
+    gfile = GFile('https://46.gigafile.nu/0101-abcdef', progress=False)
+    result = func(gfile, text)
+    tracemalloc.start()
+    func(gfile, text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func(gfile, text)
+    elapsed = time.perf_counter() - started
+    print(f'{fixture:>8} {name:>4}: {elapsed / rounds * 1000:.3f} ms/page, peak {bytes_to_size_str(peak)}')
+    return result, elapsed
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for fixture, text in (('single', single_page()), ('matomete', matomete_page(files))):
+        print(f'{fixture}: {bytes_to_size_str(len(text.encode()))}')
+        soup, soup_time = run('soup', soup_parse, fixture, text, rounds)
+        fast, fast_time = run('fast', fast_parse, fixture, text, rounds)
+        assert fast == soup, (fast, soup)
+        print(f'{fixture:>8}: {soup_time / fast_time:.1f}x faster, same {len(fast[1])} files')
+
+
+if __name__ == '__main__':
+    main()
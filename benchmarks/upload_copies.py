@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Bytes copied in Python per uploaded byte, old chunk body vs MultipartChunkBody.
+
+The old path read the chunk into an io.BytesIO with split_file, turned the form
+into one bytes object with MultipartEncoder.to_string() and sliced that into
+128 KiB pieces. The new path yields the form preamble/epilogue as bytes and the
+file data as memoryview slices of a FileRange.
+
+    python benchmarks/upload_copies.py [chunk size, e.g. 10M] [chunks]
+
+Needs requests-toolbelt, which the upload path no longer uses, for the old path.
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from requests_toolbelt import MultipartEncoder
+
+from gigafilecli import FileRange, MultipartChunkBody, bytes_to_size_str, size_str_to_bytes, split_file
+
+
+def fields_for(chunk_no, chunks):
+    return {
+        "id": "0" * 32,
+        "name": "bench.bin",
+        "chunk": str(chunk_no),
+        "chunks": str(chunks),
+        "lifetime": "100",
+    }
+
+
+def old_body(path, chunk_no, chunks, chunk_size):
+    copied = 0
+    sent = 0
+    with io.BytesIO() as f:
+        split_file(path, f, chunk_size, start=chunk_no * chunk_size)
+        copied += f.tell()
+        f.seek(0)
+        fields = fields_for(chunk_no, chunks)
+        fields["file"] = ("blob", f, "application/octet-stream")
+        form_data_binary = MultipartEncoder(fields).to_string()
+        copied += len(form_data_binary)
+    size = len(form_data_binary)
+    update_tick = 1024 * 128
+    for offset in range(0, size, update_tick):
+        piece = form_data_binary[offset:offset + update_tick]
+        copied += len(piece)
+        sent += len(piece)
+    return copied, sent
+
+
+def new_body(path, chunk_no, chunks, chunk_size):
+    copied = 0
+    sent = 0
+    length = max(0, min(chunk_size, os.path.getsize(path) - chunk_no * chunk_size))
+    with FileRange(path, chunk_no * chunk_size, length) as payload:
+        # without mmap FileRange reads the range once into a bytearray
+        if isinstance(payload.obj, bytearray):
+            copied += len(payload)
+        for piece in MultipartChunkBody(fields_for(chunk_no, chunks), payload):
+            if isinstance(piece, bytes):
+                copied += len(piece)
+            sent += len(piece)
+    return copied, sent
+
+
+def run(name, func, path, chunks, chunk_size):
+    tracemalloc.start()
+    started = time.perf_counter()
+    copied = sent = 0
+    for chunk_no in range(chunks):
+        c, s = func(path, chunk_no, chunks, chunk_size)
+        copied += c
+        sent += s
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:>4}: {copied / sent:.3f} bytes copied per uploaded byte, '
+          f'peak {bytes_to_size_str(peak)}, {bytes_to_size_str(sent / elapsed)}/s')
+
+
+def main():
+    chunk_size = size_str_to_bytes(sys.argv[1] if len(sys.argv) > 1 else '10M')
+    chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.bin')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(chunk_size * chunks - 12345))
+        print(f'{chunks} chunks of {bytes_to_size_str(chunk_size)}')
+        run('old', old_body, path, chunks, chunk_size)
+        run('new', new_body, path, chunks, chunk_size)
+
+
+if __name__ == '__main__':
+    main()
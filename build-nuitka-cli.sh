@@ -8,6 +8,14 @@ rm -rf build-nuitka-cli dist-nuitka-cli
 # CLI用ビルドディレクトリ作成
 mkdir -p build-nuitka-cli dist-nuitka-cli
 
+# 任意の依存パッケージ aiohttp（--async）と py7zr（7zの展開）はインストールされていれば同梱
+OPTIONAL_PACKAGES=""
+for pkg in aiohttp py7zr; do
+    if python3 -c "import $pkg" 2>/dev/null; then
+        OPTIONAL_PACKAGES="$OPTIONAL_PACKAGES --include-package=$pkg"
+    fi
+done
+
 # Nuitkaでスタンドアロン版（ディレクトリ版）をビルド
 echo "Building standalone version..."
 python3 -m nuitka \
@@ -17,7 +25,7 @@ python3 -m nuitka \
     --include-package=requests \
     --include-package=urllib3 \
     --include-package=bs4 \
-    --include-package=requests_toolbelt \
+    $OPTIONAL_PACKAGES \
     --include-package=tqdm \
     --nofollow-import-to=tkinter \
     --nofollow-import-to=torch \
@@ -133,7 +141,7 @@ if [ -f "dist-nuitka-cli/gigafilecli.dist/gigafile" ]; then
         --include-package=requests \
         --include-package=urllib3 \
         --include-package=bs4 \
-        --include-package=requests_toolbelt \
+        $OPTIONAL_PACKAGES \
         --include-package=tqdm \
         --nofollow-import-to=tkinter \
         --nofollow-import-to=torch \
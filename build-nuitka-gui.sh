@@ -8,6 +8,14 @@ rm -rf build-nuitka-gui dist-nuitka-gui
 # GUI用ビルドディレクトリ作成
 mkdir -p build-nuitka-gui dist-nuitka-gui
 
+# 任意の依存パッケージ py7zr（7zの展開）はインストールされていれば同梱
+OPTIONAL_PACKAGES=""
+for pkg in py7zr; do
+    if python3 -c "import $pkg" 2>/dev/null; then
+        OPTIONAL_PACKAGES="$OPTIONAL_PACKAGES --include-package=$pkg"
+    fi
+done
+
 # NuitkaでGUIアプリケーションをビルド（macOS .app形式）
 echo "Building GUI application..."
 python3 -m nuitka \
@@ -21,7 +29,7 @@ python3 -m nuitka \
     --include-package=requests \
     --include-package=urllib3 \
     --include-package=bs4 \
-    --include-package=requests_toolbelt \
+    $OPTIONAL_PACKAGES \
     --include-package=tqdm \
     --nofollow-import-to=torch \
     --nofollow-import-to=torchvision \
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
+import multiprocessing
 import threading
 import os
 import sys
@@ -9,40 +10,62 @@ from pathlib import Path
 import queue
 import re
 import zipfile
-import tempfile
 from datetime import datetime
 
 # GFile module integrated
+import collections
 import concurrent.futures
+import contextlib
+import errno
 import functools
+import gzip
+import hashlib
+import html
+import http.client
 import io
+import json
 import math
+import mmap
+import random
+import shutil
+import socket
+import sqlite3
+import struct
+import tarfile
 import time
 import uuid
+import zlib
 from os import rename
 from subprocess import run
 import requests
 from bs4 import BeautifulSoup
 from requests.adapters import HTTPAdapter
-from requests_toolbelt import MultipartEncoder, StreamingIterator
 from tqdm import tqdm
 from urllib3.util.retry import Retry
-import subprocess
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
 
 
 def requests_retry_session(
     retries=5,
     backoff_factor=0.2,
-    status_forcelist=None, # (500, 502, 504)
     session=None,
+    pool_maxsize=10,
 ):
     session = session or requests.Session()
+    # only connections that could not be opened are retried here; error statuses,
+    # resets and timeouts are left to RetryPolicy, which budgets and counts them
     retry = Retry(
         total=retries,
+        connect=retries,
+        read=0,
+        status=0,
+        other=0,
         backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
@@ -58,6 +81,15 @@ def size_str_to_bytes(size_str):
     return int(math.pow(1024, units.index(unit)) * int(m['num']))
 
 
+def page_size_to_bytes(size_str):
+    """Bytes of a size as shown on a download page ("1.5GB", "300 KB"), or 0 if unknown."""
+    m = re.search(r'([\d.,]+)\s*([KMGTP]?)i?B', size_str or '', re.IGNORECASE)
+    if not m:
+        return 0
+    units = ("", "K", "M", "G", "T", "P")
+    return int(float(m[1].replace(',', '')) * 1024 ** units.index(m[2].upper()))
+
+
 def split_file(input_file, out, target_size=None, start=0, chunk_copy_size=1024*1024):
     input_file = Path(input_file)
     size = 0
@@ -90,113 +122,1751 @@ def bytes_to_size_str(bytes):
    return f"{bytes/p:.02f} {units[i]}"
 
 
-def requests_retry_session(
-    retries=5,
-    backoff_factor=0.2,
-    status_forcelist=None, # (500, 502, 504)
-    session=None,
-):
-    session = session or requests.Session()
-    retry = Retry(
-        total=retries,
-        backoff_factor=backoff_factor,
-        status_forcelist=status_forcelist,
-    )
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
+class FileRange:
+    """Read-only view of ``length`` bytes of ``path`` starting at ``start``.
+
+    The range is mmap-ed when the platform allows it, so the pages go from the
+    page cache to the socket without a copy in Python. Otherwise it is read
+    once into a buffer with ``readinto``.
+    """
+
+    def __init__(self, path, start, length):
+        self.path = path
+        self.start = start
+        self.length = length
+        self.view = None
+        self._file = None
+        self._mmap = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'rb')
+        if self.length:
+            aligned = self.start - self.start % mmap.ALLOCATIONGRANULARITY
+            try:
+                self._mmap = mmap.mmap(self._file.fileno(), self.start - aligned + self.length,
+                                       access=mmap.ACCESS_READ, offset=aligned)
+                self.view = memoryview(self._mmap)[self.start - aligned:]
+            except (OSError, ValueError):
+                self._mmap = None
+        if self.view is None:
+            buf = bytearray(self.length)
+            self._file.seek(self.start)
+            size = 0
+            while size < self.length:
+                n = self._file.readinto(memoryview(buf)[size:])
+                if not n: break
+                size += n
+            self.view = memoryview(buf)[:size]
+        return self.view
+
+    def __exit__(self, *exc):
+        self.view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a slice is still referenced (e.g. by a traceback); GC will unmap it
+                pass
+        self._file.close()
+
+
+class MultipartChunkBody:
+    """multipart/form-data body for one upload chunk.
+
+    Only the form preamble and epilogue are built as bytes; the file data is
+    yielded as memoryview slices of ``payload``. The object has a length, so
+    requests sends it with a Content-Length instead of chunked encoding, and it
+    can be iterated again when the POST is retried.
+    """
+
+    def __init__(self, fields, payload, filename='blob', content_type='application/octet-stream',
+                 block_size=1024*128, callback=None, on_sent=None, limiter=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        parts = []
+        for name, value in fields.items():
+            parts.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n')
+        parts.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n')
+        self.preamble = ''.join(parts).encode('utf-8')
+        self.epilogue = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self.payload = memoryview(payload)
+        self.block_size = block_size
+        self.callback = callback
+        self.on_sent = on_sent
+        self.limiter = limiter
+
+    def __len__(self):
+        return len(self.preamble) + len(self.payload) + len(self.epilogue)
+
+    def __iter__(self):
+        yield self.preamble
+        for offset in range(0, len(self.payload), self.block_size):
+            block = self.payload[offset:offset + self.block_size]
+            if self.limiter:
+                self.limiter.consume(len(block))
+            yield block
+            if self.callback:
+                self.callback(len(block))
+        yield self.epilogue
+        if self.callback:
+            self.callback(len(self.preamble) + len(self.epilogue))
+        if self.on_sent:
+            self.on_sent()
+
+
+class RetryPolicy:
+    """When and how long to wait before retrying a failed request.
+
+    Errors are classified as ``timeout``, ``reset`` (connection dropped),
+    ``throttled`` (429), ``server`` (5xx), ``client`` (other 4xx) or ``error``
+    (anything else); only the first four are retried. The delay grows
+    exponentially from ``base`` up to ``cap`` with full jitter, or follows
+    Retry-After on 429. One request (a chunk) may be retried ``per_chunk``
+    times in a row, a whole transfer ``per_transfer`` times. Retries, the
+    bytes sent again and the time they cost are counted for ``summary``.
+    """
+
+    RETRYABLE = ('timeout', 'reset', 'throttled', 'server')
+
+    def __init__(self, base=0.5, cap=30.0, per_chunk=8, per_transfer=64):
+        self.base = base
+        self.cap = cap
+        self.per_chunk = per_chunk
+        self.per_transfer = per_transfer
+        self.retries = 0
+        self.kinds = collections.Counter()
+        self.resent_bytes = 0
+        self.lost_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def classify(error=None, response=None):
+        if error is not None:
+            # the socket-level errors come from bodies read past urllib3 (iter_body)
+            if isinstance(error, (requests.exceptions.Timeout, socket.timeout)):
+                return 'timeout'
+            if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                                  ConnectionError, http.client.HTTPException)):
+                return 'reset'
+            if isinstance(error, requests.exceptions.RetryError):
+                return 'server'
+            return 'error'
+        if response is None or response.status_code < 400:
+            return None
+        if response.status_code == 429:
+            return 'throttled'
+        return 'server' if response.status_code >= 500 else 'client'
+
+    def delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            return min(self.cap, int(retry_after))
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def retry(self, kind, attempt, resent=0, elapsed=0.0, response=None):
+        """Count a failed attempt and return the delay before the next one, or None to give up."""
+        with self._lock:
+            if kind not in self.RETRYABLE or attempt >= self.per_chunk or self.retries >= self.per_transfer:
+                return None
+            delay = self.delay(attempt, response)
+            self.retries += 1
+            self.kinds[kind] += 1
+            self.resent_bytes += resent
+            self.lost_seconds += elapsed + delay
+            return delay
+
+    def summary(self):
+        kinds = ', '.join(f'{kind} {count}' for kind, count in self.kinds.most_common())
+        return (f'Retries: {self.retries} ({kinds}), {bytes_to_size_str(self.resent_bytes)} sent again, '
+                f'{self.lost_seconds:.1f}s lost')
+
+
+class TokenBucket:
+    """Bandwidth limit in bytes per second, shared by every thread that calls ``consume``.
+
+    A rate of 0 means unlimited. Tokens refill continuously up to ``burst``;
+    a caller may take more than there are, and the debt is paid by the
+    callers after it. ``set_rate`` takes effect immediately, also for threads
+    that are already waiting.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self._cond = threading.Condition()
+        self.tokens = 0.0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        rate = size_str_to_bytes(rate) if rate else 0
+        with self._cond:
+            self.rate = rate
+            self.burst = burst or max(rate // 4, 128 * 1024)
+            self.tokens = min(self.tokens, self.burst)
+            self._stamp = time.monotonic()
+            self._cond.notify_all()
+
+    def consume(self, n):
+        with self._cond:
+            while self.rate:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self.tokens >= 0:
+                    self.tokens -= n
+                    return
+                self._cond.wait(-self.tokens / self.rate)
+
+
+# process-wide limits, shared by all GFile instances and their workers
+UPLOAD_LIMITER = TokenBucket()
+DOWNLOAD_LIMITER = TokenBucket()
+
+
+class ChunkSequencer:
+    """Ordered completion of upload chunks.
+
+    Workers send their chunk bodies in parallel, then block in ``wait_turn``
+    until every earlier chunk has been acknowledged. ``advance`` moves the
+    cursor under the lock, and ``abort`` wakes all waiters when the upload
+    fails so no worker is left blocked.
+    """
+
+    def __init__(self, start=0, acked_bytes=0):
+        self.current = start
+        self.acked_bytes = acked_bytes
+        self.aborted = False
+        self._cond = threading.Condition()
+
+    def wait_turn(self, chunk_no):
+        with self._cond:
+            self._cond.wait_for(lambda: self.aborted or self.current == chunk_no)
+            return not self.aborted
+
+    def advance(self, chunk_no, size=0):
+        with self._cond:
+            if chunk_no != self.current:
+                raise RuntimeError(f'chunk {chunk_no} finished out of order (expected {self.current})')
+            self.current += 1
+            self.acked_bytes += size
+            self._cond.notify_all()
+            return self.current
+
+    def abort(self):
+        with self._cond:
+            self.aborted = True
+            self._cond.notify_all()
+
+
+class BufferPool:
+    """Fixed set of reusable chunk buffers.
+
+    ``acquire`` blocks while every buffer is in use, so the read-ahead stage
+    can never hold more than ``count * size`` bytes.
+    """
+
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+        self._free = queue.Queue()
+        for _ in range(count):
+            self._free.put(bytearray(size))
+
+    def acquire(self):
+        buf = self._free.get()
+        if buf is None:
+            self._free.put(None)
+            raise OSError('buffer pool closed')
+        return buf
+
+    def release(self, buf):
+        self._free.put(buf)
+
+    def close(self):
+        # wake everyone blocked in acquire()
+        self._free.put(None)
+
+
+def readinto_full(f, view):
+    size = 0
+    while size < len(view):
+        n = f.readinto(view[size:])
+        if not n: break
+        size += n
+    return size
+
+
+AUTOTUNE_MIN_CHUNK = 1024*1024
+AUTOTUNE_MAX_CHUNK = 1024*1024*100
+
+
+def autotune_chunk_size(throughput, latency, min_size=AUTOTUNE_MIN_CHUNK, max_size=AUTOTUNE_MAX_CHUNK):
+    # keep a chunk busy for at least 20 response round trips (so request overhead
+    # stays around 5%) and 2 s, but under 15 s so a retry stays cheap
+    seconds = min(max(2.0, 20 * latency), 15.0)
+    size = int(throughput * seconds) // AUTOTUNE_MIN_CHUNK * AUTOTUNE_MIN_CHUNK
+    return max(min_size, min(size, max_size))
+
+
+class ChunkLayout:
+    """Byte ranges of the upload chunks.
+
+    Every chunk is ``chunk_size`` bytes except the last one. When
+    ``first_size`` is given, chunk 0 has that size instead (the probe chunk
+    sent before the chunk size was autotuned).
+    """
+
+    def __init__(self, size, chunk_size, first_size=None):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.first_size = first_size
+
+    @property
+    def count(self):
+        if self.first_size is None:
+            return math.ceil(self.size / self.chunk_size)
+        return 1 + math.ceil((self.size - self.first_size) / self.chunk_size)
+
+    def offset(self, chunk_no):
+        if self.first_size is None or chunk_no == 0:
+            return min(chunk_no * self.chunk_size, self.size)
+        return min(self.first_size + (chunk_no - 1) * self.chunk_size, self.size)
+
+    def length(self, chunk_no):
+        return self.offset(chunk_no + 1) - self.offset(chunk_no)
+
+
+class ConcurrencyController:
+    """AIMD window for the number of upload chunks in flight.
+
+    Chunks take a slot with ``acquire`` before they are submitted and give it
+    back with ``release``. In adaptive mode (``maximum`` given) the window
+    grows by one every ``interval`` seconds while the aggregate throughput
+    keeps improving, and is halved on errors, timeouts or when the response
+    latency inflates past ``latency_factor`` times the lowest one seen. At
+    most one decrease happens per interval, so a burst of failures from one
+    window only backs off once.
+    """
+
+    def __init__(self, initial, maximum=None, minimum=1, interval=2.0, latency_factor=3.0):
+        self.adaptive = maximum is not None
+        self.maximum = max(maximum or initial, minimum)
+        self.minimum = minimum
+        self.window = max(minimum, min(initial, self.maximum))
+        self.in_flight = 0
+        self.interval = interval
+        self.latency_factor = latency_factor
+        self._cond = threading.Condition()
+        self._interval_start = time.monotonic()
+        self._interval_bytes = 0
+        self._last_throughput = 0.0
+        self._last_decrease = 0.0
+        self._base_latency = None
+
+    def acquire(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight < self.window)
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, size, latency=None):
+        if not self.adaptive:
+            return
+        with self._cond:
+            if latency is not None:
+                if self._base_latency is None or latency < self._base_latency:
+                    self._base_latency = latency
+                if latency > self.latency_factor * max(self._base_latency, 0.05):
+                    self._decrease()
+                    return
+            self._interval_bytes += size
+            now = time.monotonic()
+            elapsed = now - self._interval_start
+            if elapsed < self.interval:
+                return
+            throughput = self._interval_bytes / elapsed
+            if throughput > self._last_throughput * 1.05 and self.window < self.maximum:
+                self.window += 1
+                self._cond.notify_all()
+            self._last_throughput = throughput
+            self._interval_start = now
+            self._interval_bytes = 0
+
+    def on_error(self):
+        if not self.adaptive:
+            return
+        with self._cond:
+            self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.interval:
+            return
+        self.window = max(self.minimum, self.window // 2)
+        self._last_decrease = now
+        self._last_throughput = 0.0
+        self._interval_start = now
+        self._interval_bytes = 0
+
+
+class UploadScheduler:
+    """Chunk budget, worker pool and upload server shared by several GFile uploads.
+
+    Every chunk of every file takes a slot of the one ConcurrencyController,
+    so the number of chunks in flight stays fixed across files and a file that
+    is waiting on its first chunk or reading its tail leaves its slots to the
+    others. At most ``file_limit`` files are active at once (``files``), which
+    bounds their read-ahead buffers. Acknowledged bytes of all files are added
+    up for the aggregate throughput.
+    """
+
+    def __init__(self, budget=4, max_budget=None, file_limit=None, total=0, progress=False):
+        self.controller = ConcurrencyController(budget, maximum=max_budget)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.controller.maximum)
+        self.file_limit = file_limit or self.controller.maximum
+        self.files = threading.BoundedSemaphore(self.file_limit)
+        self.total = total
+        self.done = 0
+        self.uploads = set()
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.pbar = tqdm(total=total, unit="B", unit_scale=True, unit_divisor=1024, ncols=100, desc='total') if progress else None
+        self._server = None
+        self._lock = threading.Lock()
+
+    def server(self, session):
+        with self._lock:
+            if self._server is None:
+                self._server = re.search(r'var server = "(.+?)"', session.get('https://gigafile.nu/').text)[1]
+            return self._server
+
+    def register(self, gfile):
+        with self._lock:
+            self.uploads.add(gfile)
+        if self.cancelled:
+            gfile.failed = True
+            gfile.sequencer.abort()
+
+    def unregister(self, gfile):
+        with self._lock:
+            self.uploads.discard(gfile)
+
+    def record(self, size):
+        with self._lock:
+            self.done += size
+            if self.pbar:
+                self.pbar.update(size)
+                self.pbar.set_postfix_str(f'x{self.controller.window}', refresh=False)
+
+    @property
+    def throughput(self):
+        return self.done / max(time.monotonic() - self.started, 0.001)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return f'{bytes_to_size_str(self.done)} in {elapsed:.1f}s, {bytes_to_size_str(self.throughput)}/s'
+
+    def cancel(self):
+        self.cancelled = True
+        with self._lock:
+            uploads = list(self.uploads)
+        for gfile in uploads:
+            gfile.failed = True
+            gfile.sequencer.abort()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.pbar:
+            self.pbar.close()
+
+
+def state_dir(*parts):
+    path = Path(os.environ.get('GIGAFILE_STATE_DIR') or Path.home() / '.gigafile-manager', *parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def file_identity(path, sample_size=1024*1024):
+    """Size, mtime and a SHA-256 of the first and last MiB of ``path``."""
+    st = os.stat(path)
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        h.update(f.read(sample_size))
+        if st.st_size > sample_size:
+            f.seek(max(st.st_size - sample_size, sample_size))
+            h.update(f.read(sample_size))
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sample_sha256': h.hexdigest()}
+
+
+class UploadJournal:
+    """Crash-safe record of an upload in progress.
+
+    Holds the token, server, cookies and chunk layout of the upload, the
+    identity of the source file and how many chunks the server has
+    acknowledged. Chunks complete in order, so the acknowledged chunks are
+    always ``0 .. acked - 1``. Every update is written to a temporary file,
+    fsync-ed and renamed over the journal.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_file(cls, file_path):
+        key = hashlib.sha1(str(Path(file_path).resolve()).encode('utf-8')).hexdigest()
+        return cls(state_dir('uploads') / f'{key}.json')
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        return self.data
+
+    def save(self, **fields):
+        with self._lock:
+            # chunks are acknowledged in order, but the threads writing them down may not be
+            if fields.get('acked', 0) < self.data.get('acked', 0):
+                return
+            self.data.update(fields)
+            temp = self.path.with_suffix('.tmp')
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+
+    def remove(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+UPLOAD_LIFETIME_DAYS = 100
+
+
+class SegmentMap:
+    """Byte ranges of a segmented download that are still missing, kept next to its .dl file.
+
+    Saved like UploadJournal: to a temporary file, fsync-ed and renamed over
+    the map.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.saved = 0.0
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, size, segments):
+        temp = self.path.with_name(self.path.name + '.tmp')
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump({'size': size, 'segments': segments}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self.saved = time.monotonic()
+
+    def remove(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class DownloadSink:
+    """The .dl file of a download, written at absolute offsets by any number of threads.
+
+    The file is grown to its final ``size`` up front, after checking that the
+    disk has room for what is still missing: with posix_fallocate where the
+    platform and filesystem support it, so running out of space fails here
+    rather than near the end, otherwise by extending it. Writes use os.pwrite,
+    which leaves no shared file position to guard; where it is missing
+    (Windows) they seek and write under a lock. The descriptor is unbuffered,
+    so whatever the segment map records is already in the file.
+    """
+
+    def __init__(self, path, size):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        self.lock = None if hasattr(os, 'pwrite') else threading.Lock()
+        try:
+            self.preallocate(path, size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def preallocate(self, path, size):
+        current = os.fstat(self.fd).st_size
+        if current >= size:
+            return
+        free = shutil.disk_usage(os.path.dirname(os.path.abspath(path))).free
+        if size - current > free:
+            raise OSError(errno.ENOSPC, f'Not enough disk space for {os.path.basename(path)}: '
+                                        f'{bytes_to_size_str(size - current)} needed, {bytes_to_size_str(free)} free')
+        try:
+            os.posix_fallocate(self.fd, current, size - current)
+        except AttributeError:
+            os.ftruncate(self.fd, size)
+        except OSError as ex:
+            if ex.errno == errno.ENOSPC:
+                raise
+            # the filesystem cannot preallocate (EOPNOTSUPP, EINVAL)
+            os.ftruncate(self.fd, size)
+
+    def write(self, offset, data):
+        data = memoryview(data)
+        if self.lock:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while data:
+                    data = data[os.write(self.fd, data):]
+            return
+        while data:
+            n = os.pwrite(self.fd, data, offset)
+            data = data[n:]
+            offset += n
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_body(response, buffer):
+    """Yield the body of a streaming ``response`` as memoryview slices of ``buffer``.
+
+    Every slice is overwritten by the next one. The body is read with
+    readinto straight from the http.client response under urllib3, whose own
+    readinto (like iter_content) allocates a new bytes object per read, so
+    urllib3 does not see the body end: once http.client has read all of it
+    the connection is handed back to the pool here, even if the caller stops
+    at the last byte without reading on. A body with a Content-Encoding still has
+    to be decoded and goes through iter_content.
+    """
+    fp = getattr(response.raw, '_fp', response.raw)
+    if response.headers.get('Content-Encoding', 'identity').lower() != 'identity' or not hasattr(fp, 'readinto'):
+        for chunk in response.iter_content(chunk_size=len(buffer)):
+            yield memoryview(chunk)
+        return
+    view = memoryview(buffer)
+    while True:
+        n = fp.readinto(view)
+        if fp is not response.raw and fp.isclosed():
+            response.raw.release_conn()
+        if not n:
+            return
+        yield view[:n]
+
+
+class DownloadState:
+    """Progress of one file being downloaded into ``path`` (its .dl file)."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.size = 0
+        self.done = 0
+        self.stopped = False
+        self.segments = None
+        self.map = None
+        self.pbar = None
+        # the size shown on the page, counted in the bundle total until the real one is known
+        self.planned = 0
+        # set once size and segments are known and path exists at its full size
+        self.ready = threading.Event()
+        # SHA-256 of the first ``hashed`` bytes, fed by whichever write continues them
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.hash_lock = threading.Lock()
+
+    def hash(self, offset, data):
+        """Add ``data`` just written at ``offset`` to the hash if it continues the hashed prefix."""
+        if offset != self.hashed:
+            return
+        with self.hash_lock:
+            if offset == self.hashed:
+                self.hasher.update(data)
+                self.hashed += len(data)
+
+    def reset_hash(self):
+        with self.hash_lock:
+            self.hasher = hashlib.sha256()
+            self.hashed = 0
+
+    def catch_up(self, end):
+        """Hash what is already in the file from the hashed prefix up to ``end``.
+
+        Needed for bytes that were there before (a resumed download) or that
+        a later segment wrote before the prefix reached them.
+        """
+        with self.hash_lock:
+            if self.hashed >= end:
+                return
+            buf = bytearray(1024 * 1024)
+            view = memoryview(buf)
+            with open(self.path, 'rb') as f:
+                f.seek(self.hashed)
+                while self.hashed < end:
+                    n = f.readinto(view[:min(len(buf), end - self.hashed)])
+                    if not n:
+                        break
+                    self.hasher.update(view[:n])
+                    self.hashed += n
+
+
+class BundleProgress:
+    """Bytes and files done across files downloaded together: a matomete page, or a whole batch.
+
+    ``total`` starts from the sizes the pages show and is corrected as the
+    real size of each file becomes known. It may be shared by the GFiles of
+    several pages downloading at once, so updates go through ``lock``.
+    """
+
+    def __init__(self, files, pbar=None, total=0):
+        self.files = files
+        self.files_done = 0
+        self.done = 0
+        self.total = total
+        self.pbar = pbar
+        self.lock = threading.Lock()
+        if pbar is not None:
+            pbar.total = total
+
+    def add(self, size, done, planned=0):
+        # called once per file, when its size is known; ``planned`` is what the page said
+        with self.lock:
+            self.total += size - planned
+            self.done += done
+            # a tqdm with total 0 is falsy
+            if self.pbar is not None:
+                self.pbar.total = self.total
+                self.pbar.update(done)
+
+    def advance(self, n):
+        with self.lock:
+            self.done += n
+            if self.pbar is not None:
+                self.pbar.update(n)
+
+    def file_done(self):
+        with self.lock:
+            self.files_done += 1
+
+
+# extraction workers get members in batches of 8 MiB up to this many bytes;
+# an archive smaller than two batches is not worth starting processes for
+EXTRACT_BATCH_SIZE = 64 * 1024 * 1024
+
+# the data filter refuses absolute paths, links out of the tree and devices;
+# Pythons without it (before 3.11.4) get the same checks from check_tar_member
+TAR_FILTER = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+
+def check_tar_member(member, dest):
+    """Return ``member`` if extracting it into ``dest`` is safe, else raise tarfile.TarError.
+
+    Without tarfile's data filter this refuses what the filter would: absolute
+    paths, paths or link targets that leave ``dest`` (``..``, or a link
+    extracted earlier), and anything but files, directories and links.
+    """
+    if TAR_FILTER:
+        return member
+    root = os.path.realpath(dest)
+
+    def inside(name):
+        path = os.path.realpath(os.path.join(root, name))
+        return not os.path.isabs(name) and (path == root or path.startswith(root + os.sep))
+
+    if not inside(member.name):
+        raise tarfile.TarError(f'{member.name} would be extracted outside {dest}')
+    if member.issym() and not inside(os.path.join(os.path.dirname(member.name), member.linkname)) \
+            or member.islnk() and not inside(member.linkname):
+        raise tarfile.TarError(f'{member.name} links to {member.linkname}, outside {dest}')
+    if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+        raise tarfile.TarError(f'{member.name} is not a regular file, directory or link')
+    return member
+
+
+def check_tar_members(members, dest):
+    """check_tar_member for each of ``members`` as it is extracted."""
+    for member in members:
+        yield check_tar_member(member, dest)
+
+
+def archive_kind(filename):
+    """'zip', 'tar' (also .tar.gz), 'gz', '7z' or None, by extension."""
+    name = filename.lower()
+    if name.endswith(('.tar', '.tar.gz')):
+        return 'tar'
+    for kind in ('gz', 'zip', '7z'):
+        if name.endswith('.' + kind):
+            return kind
+    return None
+
+
+def place_extracted(temp, dest, filename):
+    """Move what was extracted into ``temp`` to ``dest`` like unar; returns the new path.
+
+    A single top-level entry keeps its name, several go into a directory
+    named after the archive.
+    """
+    dest = Path(dest)
+    entries = list(Path(temp).iterdir())
+    if len(entries) == 1 and not (dest / entries[0].name).exists():
+        target = dest / entries[0].name
+        os.replace(entries[0], target)
+        Path(temp).rmdir()
+        return target
+    stem = filename
+    for suffix in ('.gz', '.tar', '.zip', '.7z'):
+        if stem.lower().endswith(suffix):
+            stem = stem[:-len(suffix)]
+    target = dest / stem
+    i = 1
+    while target.exists():
+        target = dest / f'{stem}-{i}'
+        i += 1
+    os.replace(temp, target)
+    return target
+
+
+def _extract_batch(path, kind, members, temp):
+    """Extract ``members`` of the archive at ``path`` into ``temp``: zip
+    member indices or tar header offsets. Returns the bytes written."""
+
+    def retrying(extract, *args, **kwargs):
+        try:
+            extract(*args, **kwargs)
+        except FileExistsError:
+            # another worker created the same directory at the same moment
+            extract(*args, **kwargs)
+
+    size = 0
+    if kind == 'zip':
+        with zipfile.ZipFile(path) as zf:
+            infos = zf.infolist()
+            for i in members:
+                retrying(zf.extract, infos[i], temp)
+                size += infos[i].file_size
+    else:
+        with tarfile.open(path, 'r:') as tar:
+            for offset in members:
+                tar.fileobj.seek(offset)
+                member = tarfile.TarInfo.fromtarfile(tar)
+                retrying(tar.extract, check_tar_member(member, temp), temp, **TAR_FILTER)
+                size += member.size
+    return size
+
+
+def extract_archive(path, dest, workers=None, report=None):
+    """Extract the archive at ``path`` into ``dest`` (see place_extracted); returns where it went.
+
+    Members of a zip or an uncompressed tar are extracted in batches by a
+    pool of ``workers`` processes (default: one per CPU). A compressed tar
+    or a .gz can only be read in order; a 7z needs the optional py7zr.
+    ``report(done, total)`` gets the bytes extracted so far.
+    """
+    path = Path(path)
+    kind = archive_kind(path.name)
+    report = report or (lambda done, total: None)
+    temp = Path(dest) / f'.{path.name}.extracting'
+    shutil.rmtree(temp, ignore_errors=True)
+    temp.mkdir()
+    try:
+        jobs = []
+        if kind == 'zip':
+            with zipfile.ZipFile(path) as zf:
+                jobs = [(i, info.file_size) for i, info in enumerate(zf.infolist())]
+        elif kind == 'tar':
+            try:
+                with tarfile.open(path, 'r:') as tar:
+                    members = tar.getmembers()
+            except tarfile.ReadError:
+                # compressed
+                members = None
+            else:
+                jobs = [(member.offset, member.size) for member in members if member.isreg()]
+        if jobs:
+            total = sum(size for _, size in jobs)
+            workers = max(1, workers or os.cpu_count() or 1)
+            # several batches per worker, so they finish together
+            target = max(8 * 1024 * 1024, min(EXTRACT_BATCH_SIZE, total // (workers * 4)))
+            batches = [[]]
+            batch_size = 0
+            for member, size in jobs:
+                if batch_size >= target:
+                    batches.append([])
+                    batch_size = 0
+                batches[-1].append(member)
+                batch_size += size
+            workers = min(workers, len(batches))
+            done = 0
+            report(done, total)
+            if workers > 1:
+                # spawn, like write_zip: downloads run in threads next to it
+                with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    futures = [pool.submit(_extract_batch, str(path), kind, batch, str(temp)) for batch in batches]
+                    try:
+                        for future in concurrent.futures.as_completed(futures):
+                            done += future.result()
+                            report(done, total)
+                    except BaseException:
+                        pool.shutdown(wait=True, cancel_futures=True)
+                        raise
+            else:
+                for batch in batches:
+                    done += _extract_batch(str(path), kind, batch, str(temp))
+                    report(done, total)
+            if kind == 'tar':
+                # directories (their modes apply last) and links to the files above
+                with tarfile.open(path, 'r:') as tar:
+                    tar.extractall(temp, members=check_tar_members([member for member in members if not member.isreg()], temp), **TAR_FILTER)
+        elif kind in ('tar', 'gz'):
+            total = path.stat().st_size
+            with open(path, 'rb') as f:
+                if kind == 'tar':
+
+                    def reporting(tar):
+                        for member in tar:
+                            report(f.tell(), total)
+                            yield member
+
+                    with tarfile.open(fileobj=f, mode='r|*') as tar:
+                        tar.extractall(temp, members=check_tar_members(reporting(tar), temp), **TAR_FILTER)
+                else:
+                    with gzip.GzipFile(fileobj=f) as gz, open(temp / path.name[:-3], 'wb') as out:
+                        while True:
+                            data = gz.read(1024 * 1024)
+                            if not data:
+                                break
+                            out.write(data)
+                            report(f.tell(), total)
+                report(total, total)
+        elif kind == '7z':
+            if py7zr is None:
+                raise RuntimeError('extracting 7z archives needs py7zr (pip install py7zr)')
+            with py7zr.SevenZipFile(path) as archive:
+                total = archive.archiveinfo().uncompressed
+                report(0, total)
+                archive.extractall(temp)
+                report(total, total)
+        elif kind is None:
+            raise ValueError(f'{path.name} is not a supported archive')
+    except BaseException:
+        shutil.rmtree(temp, ignore_errors=True)
+        raise
+    return place_extracted(temp, dest, path.name)
+
+
+class PartialFile(io.RawIOBase):
+    """Read-only view of the .dl file of a download that is still running.
+
+    ``state.segments`` are the byte ranges not written yet (None: not known,
+    so all of them); a read of one of them waits until it arrives, or raises
+    once ``aborted`` is set, or ``ended`` as nothing more will arrive. Ranges
+    fetched separately (the end of a zip) are added to ``extra`` as
+    ``(offset, bytes)`` and read from there.
+    """
+
+    def __init__(self, state, aborted, ended):
+        self.f = open(state.path, 'rb')
+        self.state = state
+        self.aborted = aborted
+        self.ended = ended
+        self.extra = []
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.state.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.state.size - self.pos)
+        if n <= 0:
+            return 0
+        for start, data in self.extra:
+            if start <= self.pos < start + len(data):
+                n = min(n, start + len(data) - self.pos)
+                b[:n] = data[self.pos - start:self.pos - start + n]
+                self.pos += n
+                return n
+        n = self._available(n)
+        self.f.seek(self.pos)
+        n = self.f.readinto(memoryview(b)[:n])
+        self.pos += n
+        return n
+
+    def _available(self, n):
+        # how much of the next n bytes is on disk, once there is any
+        while True:
+            end = self.pos + n
+            segments = self.state.segments
+            for pos, stop in list(segments if segments is not None else [[0, self.state.size]]):
+                if pos <= self.pos < stop:
+                    break
+                if self.pos < pos < end:
+                    end = pos
+            else:
+                return end - self.pos
+            if self.ended.is_set():
+                raise OSError(f'bytes at {self.pos} missing after the download ended')
+            if self.aborted.wait(0.05):
+                raise OSError('download stopped')
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def zip_directory_offset(tail, size):
+    """Offset of the central directory of a zip of ``size`` bytes that ends with ``tail``, or None."""
+    i = tail.rfind(b'PK\x05\x06')
+    if i < 0 or len(tail) - i < 22:
+        return None
+    offset, = struct.unpack('<I', tail[i + 16:i + 20])
+    if offset != 0xFFFFFFFF:
+        return offset
+    # ZIP64: the end of central directory locator points at the ZIP64 record holding the offset
+    j = i - 20
+    if j < 0 or tail[j:j + 4] != b'PK\x06\x07':
+        return None
+    record, = struct.unpack('<Q', tail[j + 8:j + 16])
+    k = record - (size - len(tail))
+    if k < 0 or tail[k:k + 4] != b'PK\x06\x06':
+        return None
+    offset, = struct.unpack('<Q', tail[k + 48:k + 56])
+    return offset
+
+
+class StreamExtractor:
+    """Unpacks an archive from its .dl file while it is downloading.
+
+    A tar (plain or compressed) or a .gz is read in order as its bytes
+    arrive. A zip starts once its central directory is known, fetched with
+    ``fetch_range(start, end)`` (a Range request returning bytes, or None if
+    the server cannot), and extracts members as they complete. Everything is
+    unpacked into a hidden directory in ``dest`` that ``finish`` moves into
+    place (see place_extracted). A 7z is left to extract_archive after the
+    download.
+    """
+
+    KINDS = ('zip', 'tar', 'gz')
+    TAIL = 1024 * 1024
+
+    def __init__(self, state, dest, filename, fetch_range):
+        self.state = state
+        self.dest = Path(dest)
+        self.filename = filename
+        self.fetch_range = fetch_range
+        self.kind = archive_kind(filename)
+        self.temp = self.dest / f'.{filename}.extracting'
+        self.aborted = threading.Event()
+        # set by finish: the download is over, so a read that would wait fails instead
+        self.ended = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def abort(self):
+        self.aborted.set()
+
+    def _run(self):
+        try:
+            while not self.state.ready.wait(0.05):
+                if self.aborted.is_set() or self.ended.is_set():
+                    return
+            shutil.rmtree(self.temp, ignore_errors=True)
+            self.temp.mkdir()
+            with io.BufferedReader(PartialFile(self.state, self.aborted, self.ended), 1024 * 1024) as f:
+                if self.kind == 'zip':
+                    self._unzip(f)
+                elif self.kind == 'tar':
+                    with tarfile.open(fileobj=f, mode='r|*') as tar:
+                        tar.extractall(self.temp, members=check_tar_members(tar, self.temp), **TAR_FILTER)
+                else:
+                    with gzip.GzipFile(fileobj=f) as gz, open(self.temp / self.filename[:-3], 'wb') as out:
+                        shutil.copyfileobj(gz, out, 1024 * 1024)
+        except Exception as ex:
+            self.error = ex
+
+    def _unzip(self, f):
+        raw = f.raw
+        size = self.state.size
+        start = max(0, size - self.TAIL)
+        tail = self.fetch_range(start, size) if start else None
+        if tail is not None:
+            raw.extra.append((start, tail))
+            offset = zip_directory_offset(tail, size)
+            if offset is not None and offset < start:
+                directory = self.fetch_range(offset, start)
+                if directory is not None:
+                    raw.extra.append((offset, directory))
+        with zipfile.ZipFile(f) as zf:
+            # in file order, so each member is extracted as soon as the download passes it
+            for info in sorted(zf.infolist(), key=lambda info: info.header_offset):
+                zf.extract(info, self.temp)
+
+    def finish(self):
+        """Wait for the extraction; returns where it was put, or None (and cleans up) if it failed."""
+        self.ended.set()
+        self.thread.join()
+        if self.error is not None or self.aborted.is_set() or not self.temp.exists():
+            shutil.rmtree(self.temp, ignore_errors=True)
+            return None
+        return place_extracted(self.temp, self.dest, self.filename)
+
+
+class UploadCache:
+    """SQLite index from file content to the URL it was uploaded to.
+
+    Uploads are keyed by SHA-256 and size of their content and expire with
+    the link (``lifetime`` days after the upload). A second table maps the
+    quick ``file_identity`` of a file to its content hash, so an unchanged
+    file is found without reading it. Every call opens its own connection,
+    so one cache can be shared by upload threads.
+    """
+
+    def __init__(self, path=None, lifetime=UPLOAD_LIFETIME_DAYS, margin=24*60*60):
+        self.path = Path(path) if path else state_dir() / 'uploads.sqlite3'
+        self.lifetime = lifetime
+        self.margin = margin
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS uploads (sha256 TEXT, size INTEGER, name TEXT, url TEXT, '
+                         'uploaded REAL, expires REAL, PRIMARY KEY (sha256, size))')
+            conn.execute('CREATE TABLE IF NOT EXISTS identities (identity TEXT PRIMARY KEY, sha256 TEXT, size INTEGER)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _identity_key(identity):
+        return json.dumps(identity, sort_keys=True)
+
+    def lookup(self, sha256, size):
+        # links still alive for at least `margin` seconds
+        with self._connect() as conn:
+            row = conn.execute('SELECT url, expires FROM uploads WHERE sha256 = ? AND size = ? AND expires > ?',
+                               (sha256, size, time.time() + self.margin)).fetchone()
+        return row
+
+    def lookup_identity(self, identity):
+        with self._connect() as conn:
+            row = conn.execute('SELECT sha256 FROM identities WHERE identity = ?', (self._identity_key(identity),)).fetchone()
+        return self.lookup(row[0], identity['size']) if row else None
+
+    def has_size(self, size):
+        with self._connect() as conn:
+            row = conn.execute('SELECT 1 FROM uploads WHERE size = ? AND expires > ? LIMIT 1',
+                               (size, time.time() + self.margin)).fetchone()
+        return row is not None
+
+    def store(self, sha256, size, name, url, identity=None):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)',
+                         (sha256, size, name, url, now, now + self.lifetime * 24 * 60 * 60))
+        if identity:
+            self.remember(identity, sha256)
+
+    def remember(self, identity, sha256):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO identities VALUES (?, ?, ?)', (self._identity_key(identity), sha256, identity['size']))
+
+    def prune(self):
+        """Drop expired uploads and identities that no longer lead to one. Returns the number of uploads dropped."""
+        with self._connect() as conn:
+            removed = conn.execute('DELETE FROM uploads WHERE expires <= ?', (time.time(),)).rowcount
+            conn.execute('DELETE FROM identities WHERE NOT EXISTS '
+                         '(SELECT 1 FROM uploads WHERE uploads.sha256 = identities.sha256 AND uploads.size = identities.size)')
+        return removed
+
+
+# parsed download pages are reused for this long; names, sizes and ids only change when the upload expires
+PAGE_CACHE_TTL = 24 * 60 * 60
+
+
+class PageCache:
+    """SQLite cache of parsed download pages and the cookies they set.
+
+    Entries are keyed by the page URL, plus a SHA-256 of the password for
+    pages that need one, and hold what GFile.resolve found (matomete flag and
+    files) until ``ttl`` seconds after the page was fetched. A retry pass or
+    a second run of the same URL list then goes straight to download.php;
+    should the cookie have expired, GFile fetches the page again. Every call
+    opens its own connection, like UploadCache.
+    """
+
+    def __init__(self, path=None, ttl=PAGE_CACHE_TTL):
+        self.path = Path(path) if path else state_dir() / 'pages.sqlite3'
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, matomete INTEGER, files TEXT, '
+                         'cookies TEXT, fetched REAL, expires REAL)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _key(url, password=None):
+        return url if not password else f'{url}#{hashlib.sha256(password.encode("utf-8")).hexdigest()}'
+
+    def lookup(self, url, password=None):
+        """(matomete, files, cookies) of a page fetched less than ``ttl`` seconds ago, or None."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT matomete, files, cookies FROM pages WHERE key = ? AND expires > ?',
+                               (self._key(url, password), time.time())).fetchone()
+        if row is None:
+            return None
+        return bool(row[0]), [tuple(info) for info in json.loads(row[1])], json.loads(row[2])
+
+    def store(self, url, password, matomete, files, cookies):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+                         (self._key(url, password), int(matomete), json.dumps(files), json.dumps(cookies), now, now + self.ttl))
+
+    def forget(self, url, password=None):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM pages WHERE key = ?', (self._key(url, password),))
+
+    def prune(self):
+        """Drop expired pages. Returns the number dropped."""
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM pages WHERE expires <= ?', (time.time(),)).rowcount
+
+
+class PageExpired(Exception):
+    """download.php answered with a page instead of the file: the cookie (from the page cache or the session) is no longer valid."""
+
+
+def file_sha256(path, block_size=1024*1024):
+    h = hashlib.sha256()
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(path, 'rb') as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+class ChunkWriter:
+    """Write-only file object that cuts whatever is written to it into upload chunks.
+
+    Full chunks are put on ``chunks`` as ``(buffer, size)`` pairs and ``None``
+    marks the end of the stream. Buffers come from ``pool``, so a producer
+    that outruns the upload blocks instead of growing memory.
+    """
+
+    def __init__(self, pool, chunk_size):
+        self.pool = pool
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue()
+        self.aborted = False
+        self.closed = False
+        self._buf = None
+        self._size = 0
+
+    def write(self, data):
+        if self.aborted:
+            raise OSError('upload aborted')
+        data = memoryview(data).cast('B')
+        written = len(data)
+        while data:
+            if self._buf is None:
+                self._buf = self.pool.acquire()
+                self._size = 0
+            n = min(len(data), self.chunk_size - self._size)
+            self._buf[self._size:self._size + n] = data[:n]
+            self._size += n
+            data = data[n:]
+            if self._size == self.chunk_size:
+                self.chunks.put((self._buf, self._size))
+                self._buf = None
+        return written
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._buf is not None:
+            self.chunks.put((self._buf, self._size))
+            self._buf = None
+        self.chunks.put(None)
+
+    def abort(self):
+        self.aborted = True
+
+
+ZIP_BLOCK_SIZE = 1024 * 1024
+ZIP_SAMPLE_SIZE = 64 * 1024
+ZIP64_LIMIT = (1 << 31) - 1
+_ZIP_WINDOW = 32 * 1024
+_ZIP_ZEROS = bytes(ZIP_BLOCK_SIZE)
+
+
+def _deflate_block(path, offset, length, level, final):
+    # runs in a worker process; the previous 32 KiB are used as the dictionary so
+    # the independently compressed blocks lose (almost) nothing against one stream
+    with open(path, 'rb') as f:
+        start = max(0, offset - _ZIP_WINDOW)
+        f.seek(start)
+        zdict = f.read(offset - start)
+        data = f.read(length)
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    # a sync flush ends the block on a byte boundary without marking it final,
+    # so the blocks can simply be concatenated into one deflate stream
+    out = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return out, zlib.crc32(data), len(data)
+
+
+def crc32_combine(crc1, crc2, len2):
+    """CRC-32 of A + B from crc1 = crc32(A), crc2 = crc32(B) and len(B) <= ZIP_BLOCK_SIZE."""
+    zeros = memoryview(_ZIP_ZEROS)[:len2]
+    return zlib.crc32(zeros, crc1) ^ zlib.crc32(zeros) ^ crc2
+
+
+def is_compressible(path, size, level=1, threshold=0.95):
+    # sample a few pieces spread over the file; video, JPEG and existing archives barely shrink
+    samples = min(4, max(1, size // ZIP_SAMPLE_SIZE))
+    raw = packed = 0
+    with open(path, 'rb') as f:
+        for n in range(samples):
+            f.seek(size * n // samples)
+            data = f.read(ZIP_SAMPLE_SIZE)
+            raw += len(data)
+            packed += len(zlib.compress(data, level))
+    return raw > 0 and packed < raw * threshold
+
+
+class _ZipMember:
+    def __init__(self, path, arcname, offset):
+        st = os.stat(path)
+        self.path = path
+        self.arcname = arcname.encode('utf-8')
+        self.size = st.st_size
+        self.offset = offset
+        self.zip64 = self.size * 1.05 > ZIP64_LIMIT
+        self.method = zipfile.ZIP_STORED
+        self.crc = 0
+        self.compress_size = 0
+        self.external_attr = (st.st_mode & 0xFFFF) << 16
+        y, m, d, hh, mm, ss = time.localtime(st.st_mtime)[:6]
+        if y < 1980:
+            y, m, d, hh, mm, ss = 1980, 1, 1, 0, 0, 0
+        self.dos_date = (y - 1980) << 9 | m << 5 | d
+        self.dos_time = hh << 11 | mm << 5 | ss // 2
+
+    @property
+    def version(self):
+        return 45 if self.zip64 else 20
+
+    def local_header(self):
+        # sizes and CRC follow the data in a data descriptor (flag bit 3), names are UTF-8 (bit 11)
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if self.zip64 else b''
+        size = 0xFFFFFFFF if self.zip64 else 0
+        return struct.pack('<4s5H3L2H', b'PK\x03\x04', self.version, 0x0808, self.method,
+                           self.dos_time, self.dos_date, 0, size, size,
+                           len(self.arcname), len(extra)) + self.arcname + extra
+
+    def data_descriptor(self):
+        if self.zip64:
+            return struct.pack('<4sLQQ', b'PK\x07\x08', self.crc, self.compress_size, self.size)
+        return struct.pack('<4s3L', b'PK\x07\x08', self.crc, self.compress_size, self.size)
+
+    def central_header(self):
+        values = []
+        sizes = []
+        for value in (self.size, self.compress_size):
+            if self.zip64 or value > ZIP64_LIMIT:
+                values.append(value)
+                sizes.append(0xFFFFFFFF)
+            else:
+                sizes.append(value)
+        offset = self.offset
+        if offset > ZIP64_LIMIT:
+            values.append(offset)
+            offset = 0xFFFFFFFF
+        extra = struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values) if values else b''
+        version = 45 if values else self.version
+        made_by = (0 if os.name == 'nt' else 3) << 8 | version
+        return struct.pack('<4s6H3L5H2L', b'PK\x01\x02', made_by, version, 0x0808, self.method,
+                           self.dos_time, self.dos_date, self.crc, sizes[1], sizes[0],
+                           len(self.arcname), len(extra), 0, 0, 0, self.external_attr, offset) + self.arcname + extra
+
+
+def _zip_end_records(count, cd_offset, cd_size):
+    records = b''
+    if count >= 0xFFFF or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+        zip64_offset = cd_offset + cd_size
+        records += struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        records += struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_offset, 1)
+        count, cd_offset, cd_size = min(count, 0xFFFF), min(cd_offset, 0xFFFFFFFF), min(cd_size, 0xFFFFFFFF)
+    return records + struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0)
+
+
+def write_zip(file_paths, fileobj, workers=None, level=6, report=print):
+    """Write a ZIP of ``file_paths`` (stored under their basenames) to ``fileobj``.
+
+    Members are deflated in ``ZIP_BLOCK_SIZE`` blocks by a pool of ``workers``
+    processes (default: one per CPU) and written in order, so ``fileobj`` only
+    needs ``write`` (e.g. a ChunkWriter). Members that do not compress in a
+    sample are stored as-is. The achieved throughput is passed to ``report``.
+    """
+    paths = [path for path in file_paths if os.path.isfile(path)]
+    blocks = sum(-(-os.path.getsize(path) // ZIP_BLOCK_SIZE) for path in paths)
+    workers = max(1, min(workers or os.cpu_count() or 1, blocks))
+    started = time.monotonic()
+    # spawn: the producer runs next to upload threads, which fork does not mix well with
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) if workers > 1 else None
+    pending = collections.deque()
+    members = []
+    written = 0
+    raw_size = 0
+
+    def jobs():
+        # one job per block, in output order; stored members are read here when their turn comes
+        for path in paths:
+            member = _ZipMember(path, os.path.basename(path), 0)
+            if member.size and is_compressible(path, member.size):
+                member.method = zipfile.ZIP_DEFLATED
+            offsets = range(0, member.size, ZIP_BLOCK_SIZE) if member.size else [0]
+            for offset in offsets:
+                length = min(ZIP_BLOCK_SIZE, member.size - offset)
+                final = offset + length >= member.size
+                if member.method == zipfile.ZIP_DEFLATED:
+                    args = (path, offset, length, level, final)
+                    yield member, offset, length, pool.submit(_deflate_block, *args) if pool else _deflate_block(*args)
+                else:
+                    yield member, offset, length, None
+
+    def write(data):
+        nonlocal written
+        fileobj.write(data)
+        written += len(data)
+
+    job_iter = jobs()
+    try:
+        with contextlib.ExitStack() as stack:
+            source = None
+            while True:
+                # keep every worker busy, also across member boundaries
+                while len(pending) < workers * 4:
+                    job = next(job_iter, None)
+                    if job is None:
+                        break
+                    pending.append(job)
+                if not pending:
+                    break
+                member, offset, length, result = pending.popleft()
+                if offset == 0:
+                    member.offset = written
+                    members.append(member)
+                    write(member.local_header())
+                    stack.close()
+                    source = None
+                if member.method == zipfile.ZIP_DEFLATED:
+                    data, crc, n = result.result() if isinstance(result, concurrent.futures.Future) else result
+                    member.crc = crc32_combine(member.crc, crc, n) if offset else crc
+                else:
+                    if source is None:
+                        source = stack.enter_context(open(member.path, 'rb'))
+                    data = source.read(length)
+                    member.crc = zlib.crc32(data, member.crc)
+                write(data)
+                member.compress_size += len(data)
+                if offset + length >= member.size:
+                    write(member.data_descriptor())
+                    raw_size += member.size
+        cd_offset = written
+        for member in members:
+            write(member.central_header())
+        write(_zip_end_records(len(members), cd_offset, written - cd_offset))
+    finally:
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    stored = sum(1 for member in members if member.method == zipfile.ZIP_STORED)
+    report(f'Compressed {len(members)} files ({stored} stored) with {workers} workers: '
+           f'{bytes_to_size_str(raw_size)} -> {bytes_to_size_str(written)} '
+           f'in {elapsed:.1f}s, {bytes_to_size_str(raw_size / elapsed)}/s')
+    return written
+
+
+# tags of a page outside comments, scripts and styles
+_PAGE_ATTR = r'''([^\s"'=<>/]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?'''
+_PAGE_TOKEN_RE = re.compile(r'<!--.*?-->|<(script|style)\b[^>]*>.*?</\1\s*>|<([a-zA-Z][\w-]*)((?:\s+' + _PAGE_ATTR + r')*)\s*/?>',
+                            re.DOTALL | re.IGNORECASE)
+_PAGE_ATTR_RE = re.compile(_PAGE_ATTR)
+# the text of an element without child elements, up to its end tag
+_PAGE_TEXT_RE = re.compile(r'([^<]*)</([a-zA-Z][\w-]*)\s*>')
+_PAGE_SPAN = r'\s*<span(?:\s[^<>]*)?>([^<]*)</span\s*>'
+# the first three children of .matomete_file_info: icon, name, （size）
+_MATOMETE_INFO_RE = re.compile(r'\s*<span(?:\s[^<>]*)?>.*?</span\s*>' + _PAGE_SPAN * 2, re.DOTALL | re.IGNORECASE)
+_MATOMETE_ID_RE = re.compile(r'download\(\d+, *\'(.+?)\'')
+_MATOMETE_SIZE_RE = re.compile(r'（(.+?)）')
+
+
+def _page_attrs(attrs):
+    return {name.lower(): html.unescape(next((v for v in values if v), ''))
+            for name, *values in _PAGE_ATTR_RE.findall(attrs or '')}
+
+
+def _page_text(text, pos, tag):
+    # None when the element has child elements, like BeautifulSoup's .text would gather
+    m = _PAGE_TEXT_RE.match(text, pos)
+    if not m or m[2].lower() != tag:
+        return None
+    return html.unescape(m[1]).strip()
+
+
+def parse_download_page(text, file_id):
+    """Read the files off a download page without building a document tree.
+
+    Returns (matomete, [(name, size as shown, file id), ...]) like
+    GFile.resolve, or None when the page is not laid out as expected, so the
+    caller can fall back to BeautifulSoup. A single file page is read only up
+    to its name and size.
+    """
+    matomete = 'contents_matomete' in text
+    container = False
+    name = size_str = None
+    files = []
+    entry = None
+    for m in _PAGE_TOKEN_RE.finditer(text):
+        tag = m[2]
+        if tag is None:
+            continue
+        attrs = _page_attrs(m[3])
+        classes = attrs.get('class', '').split()
+        if attrs.get('id') == 'contents_matomete':
+            container = True
+        if not matomete:
+            if name is None and attrs.get('id') == 'dl':
+                name = _page_text(text, m.end(), tag.lower())
+                if name is None:
+                    return None
+            elif size_str is None and 'dl_size' in classes:
+                size_str = _page_text(text, m.end(), tag.lower())
+                if size_str is None:
+                    return None
+            if name is not None and size_str is not None:
+                return False, [(name, size_str, file_id)]
+        elif 'matomete_file' in classes:
+            entry = [None, None, None]
+            files.append(entry)
+        elif 'matomete_file_info' in classes:
+            info = _MATOMETE_INFO_RE.match(text, m.end())
+            if entry is None or entry[0] is not None or not info:
+                return None
+            size = _MATOMETE_SIZE_RE.search(html.unescape(info[2]).strip())
+            if not size:
+                return None
+            entry[0] = html.unescape(info[1]).strip()
+            entry[1] = size[1]
+        elif 'download_panel_btn_dl' in classes:
+            button = _MATOMETE_ID_RE.search(attrs.get('onclick', ''))
+            if entry is None or entry[2] is not None or not button:
+                return None
+            entry[2] = button[1]
+    if not container or not files or not all(all(field is not None for field in entry) for entry in files):
+        return None
+    return True, [tuple(entry) for entry in files]
+
+
+# segmented downloads never split a file into parts smaller than this
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
 
 
 class GFile:
     def __init__(self, uri, progress=False, thread_num=4, chunk_size=1024*1024*10, chunk_copy_size=1024*1024, timeout=10,
-                 aria2=False, key=None, mute=False, progress_callback=None, **kwargs) -> None:
+                 aria2=False, key=None, mute=False, progress_callback=None, readahead=2, readahead_memory='512M', autotune=False, max_threads=None, scheduler=None, cache=None, connections=1, bundle_jobs=4, page_cache=None, **kwargs) -> None:
         self.uri = uri
         self.chunk_size = size_str_to_bytes(chunk_size)
         self.chunk_copy_size = size_str_to_bytes(chunk_copy_size)
         self.thread_num=thread_num
+        self.max_threads = max_threads
+        self.scheduler = scheduler
+        self.cache = cache
+        self.retry = RetryPolicy()
+        self.connections = max(1, connections)
+        self.bundle_jobs = max(1, bundle_jobs)
+        self.bundle = None
+        self.download_stopped = False
+        self._dl_lock = threading.Lock()
+        # one dict per downloaded file, for the manifest
+        self.records = []
+        # set by resolve
+        self.files = None
+        self.matomete = False
+        self.page_cache = page_cache
+        self.cached_page = False
+        self.page_refreshed = False
+        self.hasher = None
+        self.sha256 = None
+        self.controller = None
+        self.journal = None
+        self.readahead = readahead
+        self.readahead_memory = size_str_to_bytes(readahead_memory)
+        self.buffer_pool = None
+        self.autotune = autotune
+        self.layout = None
         self.progress = progress
         self.data = None
         self.pbar = None
+        # bars not drawn on by a chunk in flight; more are made if the window grows past thread_num
+        self.free_bars = []
+        self.bar_lock = threading.Lock()
         self.timeout = timeout
-        self.session = requests_retry_session()
+        # one pooled connection per upload worker or download segment of every bundle file
+        self.session = requests_retry_session(pool_maxsize=max(10, thread_num, max_threads or 0, self.bundle_jobs * self.connections))
         self.session.request = functools.partial(self.session.request, timeout=self.timeout)
         self.cookies = None
-        self.current_chunk = 0
+        self.sequencer = ChunkSequencer()
         self.aria2 = aria2
         self.mute = mute
         self.key = key
         self.progress_callback = progress_callback
 
 
-    def upload_chunk(self, chunk_no, chunks):
-        bar = self.pbar[chunk_no % self.thread_num] if self.pbar else None
-        with io.BytesIO() as f:
-            split_file(self.uri, f, self.chunk_size, start=chunk_no * self.chunk_size, chunk_copy_size=self.chunk_copy_size)
-            chunk_size = f.tell()
-            f.seek(0)
-            fields = {
-                "id": self.token,
-                "name": Path(self.uri).name,
-                "chunk": str(chunk_no),
-                "chunks": str(chunks),
-                "lifetime": "100",
-                "file": ("blob", f, "application/octet-stream"),
-            }
-            form_data = MultipartEncoder(fields)
-            headers = {
-                "content-type": form_data.content_type,
-            }
-            # convert the form-data into a binary string, this way we can control/throttle its read() behavior
-            form_data_binary = form_data.to_string()
-            del form_data
-
-        size = len(form_data_binary)
-        if bar:
-            bar.desc = f'chunk {chunk_no + 1}/{chunks}'
-            bar.reset(total=size)
-            # bar.refresh()
-
-        def gen():
-            offset = 0
-            while True:
-                if offset < size:
-                    update_tick = 1024 * 128
-                    yield form_data_binary[offset:offset+update_tick]
-                    if bar:
-                        bar.update(min(update_tick, size - offset))
-                        bar.refresh()
-                    offset += update_tick
-                else:
-                    if chunk_no != self.current_chunk:
-                        time.sleep(0.01)
-                    else:
-                        time.sleep(0.1)
-                        break
+    def upload_chunk(self, chunk_no, chunks, payload=None, bar=None):
+        if payload is None:
+            # no read-ahead buffer: stream the file range straight into the request body
+            with FileRange(self.uri, self.layout.offset(chunk_no), self.layout.length(chunk_no)) as payload:
+                return self.upload_chunk(chunk_no, chunks, payload, bar)
+
+        fields = {
+            "id": self.token,
+            "name": Path(self.uri).name,
+            "chunk": str(chunk_no),
+            "chunks": str(chunks),
+            "lifetime": str(UPLOAD_LIFETIME_DAYS),
+        }
+
+        def update_bar(n):
+            bar.update(n)
+            bar.refresh()
+
+        timing = {}
+
+        def on_sent():
+            # the body is sent in parallel with other chunks, but the response is
+            # only read once every earlier chunk has been acknowledged
+            timing['sent'] = time.monotonic()
+            self.sequencer.wait_turn(chunk_no)
+            timing['turn'] = time.monotonic()
+
+        body = MultipartChunkBody(fields, payload, callback=update_bar if bar is not None else None, on_sent=on_sent, limiter=UPLOAD_LIMITER)
+        headers = {
+            "content-type": body.content_type,
+        }
+        attempt = 0
         while True:
+            if self.sequencer.aborted:
+                return
+            if bar is not None:
+                bar.desc = f'chunk {chunk_no + 1}/{chunks} x{self.controller.window}'
+                bar.reset(total=len(body))
+            started = time.monotonic()
+            resp = None
             try:
-                streamer = StreamingIterator(size, gen())
-                resp = self.session.post(f"https://{self.server}/upload_chunk.php", data=streamer, headers=headers)
+                resp = self.session.post(f"https://{self.server}/upload_chunk.php", data=body, headers=headers)
             except Exception as ex:
-                if not self.mute:
-                    print(ex)
-                    print('Retrying...')
+                error = ex
+                kind = self.retry.classify(error=ex)
             else:
+                kind = self.retry.classify(response=resp)
+                error = requests.HTTPError(f'{resp.status_code} {resp.reason}', response=resp) if kind else None
+            if kind is None:
                 break
+            self.controller.on_error()
+            delay = self.retry.retry(kind, attempt, len(body), time.monotonic() - started, resp)
+            if delay is None:
+                raise error
+            if not self.mute:
+                print(f'Chunk {chunk_no + 1}: {kind} ({error}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+            attempt += 1
 
+        if self.sequencer.aborted:
+            return
+        finished = time.monotonic()
+        sent, turn = timing.get('sent', finished), timing.get('turn', finished)
+        # the response latency only means something when the chunk did not have to wait for its turn;
+        # chunk 0 is sent alone and always has its turn, so the autotune probe always has one
+        latency = finished - turn if chunk_no == 0 or turn - sent < 0.001 else None
+        self._record_chunk(chunk_no, len(body), sent - started, latency)
         resp_data = resp.json()
-        self.current_chunk += 1
+        if self.hasher:
+            # still this chunk's turn, so the content is hashed in order while it is in memory
+            self.hasher.update(payload)
+        done = self.sequencer.advance(chunk_no, len(payload))
+        if self.scheduler:
+            self.scheduler.record(len(payload))
+        if 'status' in resp_data and not resp_data['status']:
+            self._save_journal(done)
 
         # プログレスコールバック実行（アップロード用）
-        if self.progress_callback and hasattr(self, 'total_chunks') and hasattr(self, 'file_size'):
-            progress_percent = int((self.current_chunk / self.total_chunks) * 100)
-            uploaded_size = self.current_chunk * self.chunk_size
-            if uploaded_size > self.file_size:
-                uploaded_size = self.file_size
-            result = self.progress_callback(progress_percent, uploaded_size, self.file_size)
+        if self.progress_callback and hasattr(self, 'file_size'):
+            uploaded_size = self.sequencer.acked_bytes
+            progress_percent = min(100, int((uploaded_size / self.file_size) * 100)) if self.file_size else 100
+            result = self.progress_callback(progress_percent, uploaded_size, self.file_size, window=self.controller.window)
             # コールバックがFalseを返した場合（停止要求）
             if result is False:
                 self.failed = True
+                self.sequencer.abort()
                 return
 
         if 'url' in resp_data:
@@ -204,55 +1874,306 @@ class GFile:
         if 'status' not in resp_data or resp_data['status']:
             print(resp_data)
             self.failed = True
+            self.sequencer.abort()
 
 
-    def upload(self):
+    def _save_journal(self, acked):
+        if not self.journal:
+            return
+        self.journal.save(
+            identity=self.journal.data['identity'],
+            token=self.token,
+            server=self.server,
+            cookies=requests.utils.dict_from_cookiejar(self.session.cookies),
+            chunk_size=self.layout.chunk_size,
+            first_size=self.layout.first_size,
+            acked=acked,
+        )
+
+
+    def _record_chunk(self, chunk_no, size, send_seconds, latency):
+        if chunk_no == 0:
+            self.probe = (size, send_seconds, latency)
+        self.controller.on_success(size, latency)
+
+
+    def _autotune(self):
+        size, send_seconds, latency = self.probe
+        throughput = size / max(send_seconds, 0.001)
+        chunk_size = autotune_chunk_size(throughput, latency)
+        self.layout = ChunkLayout(self.file_size, chunk_size, first_size=self.layout.length(0))
+        self.total_chunks = self.layout.count
+        print(f'Autotuned chunk size: {bytes_to_size_str(chunk_size)} (throughput {bytes_to_size_str(throughput)}/s, '
+              f'latency {latency * 1000:.0f} ms), total chunks: {self.total_chunks}')
+
+
+    def _take_bar(self):
+        if not self.pbar:
+            return None
+        with self.bar_lock:
+            if self.free_bars:
+                return self.free_bars.pop()
+            bar = tqdm(unit="B", unit_scale=True, leave=False, unit_divisor=1024, ncols=100, position=len(self.pbar))
+            self.pbar.append(bar)
+            return bar
+
+
+    def _upload_worker(self, chunk_no, chunks, buf=None, size=0):
+        bar = self._take_bar()
+        try:
+            self.upload_chunk(chunk_no, chunks, memoryview(buf)[:size] if buf is not None else None, bar)
+        except Exception as ex:
+            print(f'Upload chunk {chunk_no} failed: {ex}')
+            self.failed = True
+            self.sequencer.abort()
+        finally:
+            if bar is not None:
+                with self.bar_lock:
+                    self.free_bars.append(bar)
+            self.controller.release()
+            if buf is not None:
+                self.buffer_pool.release(buf)
+
+
+    def _reuse_cached(self, identity, size):
+        row = self.cache.lookup_identity(identity)
+        if row is None and self.cache.has_size(size):
+            # the file changed (or was never seen) but a live upload has the same size: one extra read may save the upload
+            self.sha256 = file_sha256(self.uri)
+            row = self.cache.lookup(self.sha256, size)
+            if row:
+                self.cache.remember(identity, self.sha256)
+        if row is None:
+            return False
+        url, expires = row
+        self.data = {'status': 0, 'url': url}
+        self.file_size = size
+        print(f'Content already uploaded, reusing its link (expires {datetime.fromtimestamp(expires).strftime("%Y-%m-%d %H:%M")})')
+        return True
+
+
+    def upload(self, resume=False):
         self.token = uuid.uuid1().hex
+        self.retry = RetryPolicy()
         self.pbar = None
         self.failed = False
+        # with a scheduler the chunk budget, worker pool and server are shared with the other files
+        self.controller = self.scheduler.controller if self.scheduler else ConcurrencyController(self.thread_num, maximum=self.max_threads)
         assert Path(self.uri).exists()
         size = Path(self.uri).stat().st_size
-        chunks = math.ceil(size / self.chunk_size)
+        self.layout = ChunkLayout(size, self.chunk_size)
+        identity = file_identity(self.uri)
+        self.sha256 = None
+        if self.cache and self._reuse_cached(identity, size):
+            return self
+        self.journal = UploadJournal.for_file(self.uri)
+        state = self.journal.load() if resume else {}
+        start = 0
+        if (state.get('identity') == identity and state.get('acked')
+                and state['acked'] >= ChunkLayout(size, state['chunk_size'], first_size=state['first_size']).count):
+            # every chunk was acknowledged but the link never arrived: no chunk is left to resume with
+            print('Every chunk in the upload journal was acknowledged without a link. Starting a new upload.')
+            state = {}
+            resume = False
+        if state.get('identity') == identity and state.get('acked'):
+            # continue the interrupted upload from the first chunk the server has not acknowledged
+            self.token = state['token']
+            self.server = state['server']
+            self.session.cookies.update(state['cookies'])
+            self.layout = ChunkLayout(size, state['chunk_size'], first_size=state['first_size'])
+            start = state['acked']
+            print(f'Resuming upload from chunk {start + 1}/{self.layout.count}')
+        else:
+            if resume:
+                print('No matching upload journal found. Starting a new upload.')
+            self.journal.data = {'identity': identity}
+        self.sequencer = ChunkSequencer(start, acked_bytes=self.layout.offset(start))
+        # a resumed upload does not see the chunks sent before, so it is not hashed
+        self.hasher = hashlib.sha256() if self.cache and not start and not self.sha256 else None
+        chunks = self.layout.count
         
         # プログレスコールバック用の情報を保存
         self.file_size = size
         self.total_chunks = chunks
         
-        print(f'Filesize {bytes_to_size_str(size)}, chunk size: {bytes_to_size_str(self.chunk_size)}, total chunks: {chunks}')
+        print(f'Filesize {bytes_to_size_str(size)}, chunk size: {bytes_to_size_str(self.layout.chunk_size)}, total chunks: {chunks}')
 
         if self.progress:
             self.pbar = []
             for i in range(self.thread_num):
                 self.pbar.append(tqdm(total=size, unit="B", unit_scale=True, leave=False, unit_divisor=1024, ncols=100, position=i))
+            self.free_bars = list(self.pbar)
 
-        self.server = re.search(r'var server = "(.+?)"', self.session.get('https://gigafile.nu/').text)[1]
-
-        # upload the first chunk to set cookies properly.
-        self.upload_chunk(0, chunks)
+        if self.scheduler:
+            if not start:
+                self.server = self.scheduler.server(self.session)
+            self.scheduler.register(self)
+            executor = contextlib.nullcontext(self.scheduler.executor)
+        else:
+            if not start:
+                self.server = re.search(r'var server = "(.+?)"', self.session.get('https://gigafile.nu/').text)[1]
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.controller.maximum)
 
-        # upload second to second last chunk(s)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_num) as ex:
-            futures = {ex.submit(self.upload_chunk, i, chunks): i for i in range(1, chunks)}
+        # chunks are read in order by this thread and uploaded by the pool; ChunkSequencer keeps their completion in order
+        self.buffer_pool = None
+        # ConcurrencyController decides how many of the pool's workers may have a chunk in flight
+        with open(self.uri, 'rb') as f, executor as ex:
+            futures = []
             try:
-                for future in concurrent.futures.as_completed(futures):
-                    if self.failed:
-                        print('Failed!')
-                        for future in futures:
-                            future.cancel()
-                        return
+                i = start
+                if not start:
+                    # upload the first chunk alone to set cookies properly.
+                    self.controller.acquire()
+                    futures.append(ex.submit(self._upload_worker, 0, chunks))
+                    futures[0].result()
+                    if self.autotune and not self.failed:
+                        self._autotune()
+                    i = 1
+                # read-ahead: one buffer per worker plus `readahead` prefetched chunks, capped by readahead_memory
+                if self.readahead > 0 and i < self.layout.count:
+                    buf_size = min(self.layout.chunk_size, size)
+                    pool_size = max(1, min(self.controller.maximum + self.readahead, self.layout.count - i, self.readahead_memory // buf_size))
+                    self.buffer_pool = BufferPool(pool_size, buf_size)
+                    print(f'Read-ahead buffers: {pool_size} x {bytes_to_size_str(buf_size)}')
+                while i < self.layout.count and not self.failed:
+                    buf, n = None, 0
+                    if self.buffer_pool:
+                        buf = self.buffer_pool.acquire()
+                        f.seek(self.layout.offset(i))
+                        n = readinto_full(f, memoryview(buf)[:self.layout.length(i)])
+                    self.controller.acquire()
+                    futures.append(ex.submit(self._upload_worker, i, self.layout.count, buf, n))
+                    i += 1
+                concurrent.futures.wait(futures)
             except KeyboardInterrupt:
                 print('\nUser cancelled the operation.')
-                for future in futures:
-                    future.cancel()
-                return
+                self.failed = True
+            finally:
+                if self.failed:
+                    self.sequencer.abort()
+                    for future in futures:
+                        future.cancel()
+                        if future.cancelled():
+                            # cancelled before it ran, so the worker never gives its slot back
+                            self.controller.release()
+                if self.scheduler:
+                    concurrent.futures.wait(futures)
+                    self.scheduler.unregister(self)
+
+        if self.pbar:
+            for bar in self.pbar:
+                bar.close()
+        print('')
+        if self.retry.retries:
+            print(self.retry.summary())
+        
+        if self.failed:
+            print(f'Upload failed. It can be resumed from chunk {self.sequencer.current + 1}.' if self.sequencer.current else 'Upload failed.')
+            return None
+        elif not self.data or 'url' not in self.data:
+            print('Something went wrong. Upload failed.', self.data)
+            return None
+        self.journal.remove()
+        if self.cache and (self.sha256 or self.hasher):
+            self.sha256 = self.sha256 or self.hasher.hexdigest()
+            self.cache.store(self.sha256, size, Path(self.uri).name, self.data['url'], identity)
+        return self # for chain
+
+
+    def upload_stream(self, write, size_hint=0):
+        """Upload whatever ``write(fileobj)`` writes, as ``Path(self.uri).name``.
+
+        The output is cut into chunks while ``write`` runs in a producer
+        thread, so producing (e.g. compressing) and uploading overlap. Only one
+        finished chunk is held back, to learn whether it is the last one; the
+        final chunk count is not known before then, so earlier chunks announce
+        one chunk more than they know about. ``size_hint`` is only used for
+        progress reporting.
+        """
+        self.token = uuid.uuid1().hex
+        self.retry = RetryPolicy()
+        self.pbar = None
+        self.failed = False
+        self.journal = None
+        self.layout = None
+        self.hasher = None
+        self.controller = ConcurrencyController(self.thread_num, maximum=self.max_threads)
+        self.sequencer = ChunkSequencer()
+        self.file_size = size_hint
+        pool_size = max(2, min(self.controller.maximum + self.readahead + 2, self.readahead_memory // self.chunk_size))
+        self.buffer_pool = BufferPool(pool_size, self.chunk_size)
+        writer = ChunkWriter(self.buffer_pool, self.chunk_size)
+
+        def produce():
+            try:
+                write(writer)
+            except Exception as ex:
+                if not writer.aborted:
+                    print(f'Failed to produce upload data: {ex}')
+                    self.failed = True
+                    self.sequencer.abort()
+            finally:
+                writer.close()
+
+        print(f'Streaming upload, chunk size: {bytes_to_size_str(self.chunk_size)}, buffers: {pool_size}')
+
+        if self.progress:
+            self.pbar = []
+            for i in range(self.thread_num):
+                self.pbar.append(tqdm(total=self.chunk_size, unit="B", unit_scale=True, leave=False, unit_divisor=1024, ncols=100, position=i))
+            self.free_bars = list(self.pbar)
+
+        self.server = re.search(r'var server = "(.+?)"', self.session.get('https://gigafile.nu/').text)[1]
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
 
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.controller.maximum) as ex:
+            futures = []
+            pending = writer.chunks.get()
+            try:
+                i = 0
+                while pending is not None and not self.failed:
+                    following = writer.chunks.get()
+                    buf, n = pending
+                    pending = None
+                    chunks = i + 1 if following is None else i + 2
+                    self.controller.acquire()
+                    futures.append(ex.submit(self._upload_worker, i, chunks, buf, n))
+                    if i == 0:
+                        # the first chunk is uploaded alone to set cookies properly.
+                        futures[0].result()
+                    pending = following
+                    i += 1
+                concurrent.futures.wait(futures)
+            except KeyboardInterrupt:
+                print('\nUser cancelled the operation.')
+                self.failed = True
+            finally:
+                if self.failed:
+                    self.sequencer.abort()
+                    for future in futures:
+                        future.cancel()
+                    # stop the producer and drain what it has queued until it has closed the stream
+                    writer.abort()
+                    self.buffer_pool.close()
+                    while pending is not None:
+                        pending = writer.chunks.get()
+        producer.join()
 
         if self.pbar:
             for bar in self.pbar:
                 bar.close()
         print('')
-        if 'url' not in self.data:
+        if self.retry.retries:
+            print(self.retry.summary())
+
+        self.file_size = self.sequencer.acked_bytes
+        if self.failed:
+            print('Upload failed.')
+            return None
+        elif not self.data or 'url' not in self.data:
             print('Something went wrong. Upload failed.', self.data)
+            return None
         return self # for chain
 
 
@@ -260,149 +2181,530 @@ class GFile:
         if not self.data or not 'url' in self.data:
             return
         f = Path(self.uri)
-        print(f"Finished at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, filename: {f.name}, size: {bytes_to_size_str(f.stat().st_size)}")
+        print(f"Finished at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, filename: {f.name}, size: {bytes_to_size_str(self.file_size)}")
         print(self.data['url'])
         return self.data['url']
 
 
-    def download(self, odir=None,):
-        output = None
-        m = re.search(r'^https?:\/\/\d+?\.gigafile\.nu\/([a-z0-9-]+)$', self.uri)
-        if not m:
-            print('Invalid URL.')
-            return
-        r = self.session.get(self.uri) # setup cookie
+    def _get(self, url, headers=None):
+        """GET ``url`` as a stream, retrying per ``self.retry`` until the response is usable."""
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            r = None
+            try:
+                r = self.session.get(url, stream=True, headers=headers)
+            except Exception as ex:
+                error = ex
+                kind = self.retry.classify(error=ex)
+            else:
+                kind = self.retry.classify(response=r)
+                if kind is None:
+                    return r
+                error = requests.HTTPError(f'{r.status_code} {r.reason}', response=r)
+                r.close()
+            delay = self.retry.retry(kind, attempt, 0, time.monotonic() - started, r)
+            if delay is None:
+                raise error
+            if not self.mute:
+                print(f'{kind} ({error}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+            attempt += 1
+
+
+    def _advance(self, state, n):
+        with self._dl_lock:
+            state.done += n
+            if state.pbar:
+                state.pbar.update(n)
+            bundle = self.bundle
+            if bundle:
+                bundle.advance(n)
+            # GUI進捗コールバック実行（ファイル名、ダウンロードサイズ、合計サイズ付き）
+            if self.progress_callback:
+                progress_percent = int((state.done / state.size) * 100) if state.size > 0 else 0
+                extra = {'bundle': (bundle.done, bundle.total, bundle.files_done, bundle.files)} if bundle else {}
+                result = self.progress_callback(progress_percent, state.name, state.done, state.size, **extra)
+                # コールバックがFalseを返した場合（停止要求）
+                if result is False:
+                    self.download_stopped = True
+            if state.map and time.monotonic() - state.map.saved > 1.0:
+                state.map.save(state.size, state.segments)
+
+
+    def _receive(self, url, state, sink, segment, response=None, restartable=False):
+        """Write the missing part ``segment = [pos, end]`` of ``url`` at its offset in ``sink``.
+
+        ``segment[0]`` moves forward as data is written. ``response`` may
+        already be streaming from ``pos``. A dropped connection is continued
+        with a Range request; if the server answers that with the whole file,
+        a ``restartable`` (single-stream) download starts over, a segment fails.
+        Progress is reported to _advance in batches, at most every 0.1s.
+        """
+        attempt = 0
+        buffer = bytearray(self.chunk_copy_size)
+        while segment[0] < segment[1] and not state.stopped and not self.download_stopped:
+            started = time.monotonic()
+            received = 0
+            r = response or self._get(url, {'Range': f'bytes={segment[0]}-{segment[1] - 1}'})
+            response = None
+            try:
+                with r:
+                    if r.status_code != 206 and segment[0]:
+                        if not restartable:
+                            raise requests.HTTPError(f'Range request answered with {r.status_code}', response=r)
+                        # the server ignored the range: start over
+                        state.reset_hash()
+                        self._advance(state, -segment[0])
+                        segment[0] = 0
+                    pending = 0
+                    reported = time.monotonic()
+                    try:
+                        for chunk in iter_body(r, buffer):
+                            chunk = chunk[:segment[1] - segment[0]]
+                            n = len(chunk)
+                            DOWNLOAD_LIMITER.consume(n)
+                            sink.write(segment[0], chunk)
+                            state.hash(segment[0], chunk)
+                            segment[0] += n
+                            received += n
+                            pending += n
+                            if segment[0] >= segment[1] or state.stopped or self.download_stopped:
+                                break
+                            if time.monotonic() - reported >= 0.1:
+                                self._advance(state, pending)
+                                pending = 0
+                                reported = time.monotonic()
+                    finally:
+                        self._advance(state, pending)
+                if segment[0] >= segment[1] or state.stopped or self.download_stopped:
+                    break
+                # the connection ended early without an error
+                kind, error = 'reset', requests.ConnectionError(f'connection closed at {segment[0]}/{segment[1]} bytes')
+            except requests.HTTPError:
+                raise
+            except Exception as ex:
+                error = ex
+                kind = self.retry.classify(error=ex)
+            if received:
+                # data arrived, so this is a new failure rather than the same one again
+                attempt = 0
+            delay = self.retry.retry(kind, attempt, 0, time.monotonic() - started)
+            if delay is None:
+                raise error
+            if not self.mute:
+                print(f'{kind} ({error}) at {bytes_to_size_str(segment[0])}, retrying in {delay:.1f}s')
+            time.sleep(delay)
+            attempt += 1
+
+
+    def _fetch(self, url, state, desc):
+        """Download ``url`` into ``state.path``, on ``self.connections`` connections if the server honors Range.
+
+        The file is preallocated by DownloadSink, so what is missing is only
+        known from its segment map. A partial file left by an earlier run is
+        continued from that map, or, without one, from the file's size.
+        Afterwards ``state.done`` of ``state.size`` bytes are in the file.
+        """
+        path, name = state.path, state.name
+        segment_map = SegmentMap(path + '.parts')
+        saved = segment_map.load() if os.path.exists(path) else {}
+        partial = os.path.getsize(path) if os.path.exists(path) else 0
+        if saved.get('segments') is not None:
+            state.segments = [segment for segment in saved['segments'] if segment[0] < segment[1]]
+            first = state.segments[0][0] if state.segments else saved['size']
+        else:
+            state.segments = None
+            first = partial
+
+        if saved.get('segments') is not None and not state.segments:
+            # every segment arrived, only the rename was missing
+            r = None
+            state.size = saved['size']
+        else:
+            content_range = None
+            # asking for an open range tells from the first response whether the server can do segments
+            try:
+                r = self._get(url, {'Range': f'bytes={first}-'} if first or self.connections > 1 else None)
+            except requests.HTTPError as ex:
+                # 416: the partial file is already complete
+                if not (first and ex.response is not None and ex.response.status_code == 416):
+                    raise
+                r = None
+                # without the size in Content-Range it cannot be checked: start over below
+                total = re.search(r'/(\d+)$', ex.response.headers.get('Content-Range', ''))
+                state.size = int(total[1]) if total else -1
+            else:
+                if r.headers.get('Content-Type', '').startswith('text/html') and not name.lower().endswith(('.htm', '.html')):
+                    r.close()
+                    raise PageExpired(f'{url} answered with a page instead of the file')
+                content_range = re.search(r'/(\d+)$', r.headers.get('Content-Range', '')) if r.status_code == 206 else None
+                state.size = int(content_range[1]) if content_range else int(r.headers['Content-Length'])
+            if first and (r is None and state.size != partial or r is not None and (
+                    not content_range or state.size != saved.get('size', state.size) or partial > state.size)):
+                # the server cannot continue this file (or it changed): start over
+                print(f'Cannot resume {name}, downloading it again.')
+                if r is not None:
+                    r.close()
+                os.remove(path)
+                segment_map.remove()
+                return self._fetch(url, state, desc)
+
+        if state.segments is None:
+            state.segments = [[partial, state.size]]
+        state.done = state.size - sum(end - pos for pos, end in state.segments)
+        if partial:
+            print(f'Resuming {name} at {bytes_to_size_str(state.done)}')
+        
+        if self.progress and not self.bundle:
+            state.pbar = tqdm(total=state.size, initial=state.done, unit='B', unit_scale=True, unit_divisor=1024, desc=desc)
+        if self.bundle:
+            self.bundle.add(state.size, state.done, state.planned)
+        # GUI進捗コールバックでファイル名とサイズを通知（ダウンロード開始時）
+        self._advance(state, 0)
+
+        if r is None:
+            segment_map.remove()
+            state.ready.set()
+            return state
+
+        if not saved.get('segments') and r.status_code == 206 and self.connections > 1:
+            # split what is missing into up to `connections` segments
+            pos, end = state.segments[0]
+            count = max(1, min(self.connections, (end - pos) // MIN_SEGMENT_SIZE))
+            bounds = [pos + (end - pos) * i // count for i in range(count + 1)]
+            state.segments = [[bounds[i], bounds[i + 1]] for i in range(count)]
+        # saved before the file grows to its full size; from here on _advance keeps it up to date
+        state.map = segment_map
+        state.map.save(state.size, state.segments)
+        with DownloadSink(path, state.size) as sink:
+            state.ready.set()
+            # the part of a resumed file that is already there, so hashing can go on inline
+            state.catch_up(min((pos for pos, end in state.segments if pos < end), default=state.size))
+            try:
+                if len(state.segments) == 1:
+                    if self.connections > 1 and r.status_code != 206:
+                        print('The server does not support Range requests. Downloading on one connection.')
+                    self._receive(url, state, sink, state.segments[0], r, restartable=True)
+                    return state
+                print(f'Downloading in {len(state.segments)} segments')
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(state.segments)) as ex:
+                    # the first segment keeps reading the response that is already open
+                    futures = [ex.submit(self._receive, url, state, sink, segment, r if i == 0 else None)
+                               for i, segment in enumerate(state.segments)]
+                    try:
+                        for future in concurrent.futures.as_completed(futures):
+                            future.result()
+                    except BaseException:
+                        state.stopped = True
+                        r.close()
+                        raise
+            finally:
+                if all(pos >= end for pos, end in state.segments):
+                    state.map.remove()
+                else:
+                    state.map.save(state.size, state.segments)
+        return state
+
+
+    def _extract(self, path, dest, state):
+        """Extract a downloaded archive with extract_archive; returns where it went, None if it failed."""
+        print(f"Extracting {path}...")
+        pbar = None
+        if self.progress and not self.bundle:
+            pbar = tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024, desc='extract')
+
+        def report(done, total):
+            if pbar is not None:
+                pbar.total = total
+                pbar.update(done - pbar.n)
+            if self.progress_callback:
+                with self._dl_lock:
+                    self.progress_callback(int(done / total * 100) if total else 100, state.name, done, total, extracting=True)
+
+        try:
+            return extract_archive(path, dest, report=report)
+        except Exception as e:
+            print(f"Failed to extract {path}: {e}")
+            return None
+        finally:
+            if pbar is not None: pbar.close()
+
+
+    def _fetch_range(self, url, start, end):
+        """Bytes ``start`` to ``end`` of ``url``, or None if the server ignores Range."""
+        with self._get(url, {'Range': f'bytes={start}-{end - 1}'}) as r:
+            return r.content if r.status_code == 206 else None
+
+
+    def _download_one(self, odir, output, idx, count, web_name, size_str, file_id):
+        """Download the ``idx``-th of ``count`` files of the page; returns its path, None if aria2 took it."""
+        print(f'Name: {web_name}, size: {size_str}, id: {file_id}')
+        # only sanitize web filename. User provided output string(s) are on their own.
+        if not output:
+            filename = re.sub(r'[\\/:*?"<>|]', '_', web_name)
+        else:
+            if count > 1:
+                # if there are more than one files, append idx to the filename
+                filename = output + f'_{idx}'
+            else:
+                filename = output
+
+        download_url = self.uri.rsplit('/', 1)[0] + '/download.php?file=' + file_id
+        if self.key:
+            download_url += f'&dlkey={self.key}'
+        if self.aria2:
+            cookie_str = "; ".join([f"{cookie.name}={cookie.value}" for cookie in self.session.cookies])
+            cmd = ['aria2c', download_url, '--header', f'Cookie: {cookie_str}', '-o', filename]
+            cmd.extend(self.aria2.split(' '))
+            run(cmd)
+            return None
+
+        # 出力ディレクトリを確保
+        uploads_dir = Path(odir) if odir else Path('./uploads')
+        uploads_dir.mkdir(exist_ok=True)
+        
+        # 一時ファイルと最終ファイルパスを出力ディレクトリ内に設定
+        final_path = uploads_dir / filename
+        temp = str(final_path) + '.dl'
+        
+        desc = filename if len(filename) <= 20 else filename[0:11] + '..' + filename[-7:]
+        state = DownloadState(web_name, temp)
+        state.planned = page_size_to_bytes(size_str)
+        started_at = datetime.now()
+        started = time.monotonic()
+        extractor = None
+        if archive_kind(filename) in StreamExtractor.KINDS:
+            # unpack while downloading instead of in a second pass afterwards
+            extractor = StreamExtractor(state, uploads_dir, filename,
+                                        functools.partial(self._fetch_range, download_url))
+            extractor.start()
+        try:
+            try:
+                self._fetch(download_url, state, desc)
+            except PageExpired:
+                self._refresh_page()
+                self._fetch(download_url, state, desc)
+        except BaseException:
+            if extractor:
+                extractor.abort()
+                extractor.finish()
+            raise
+        finally:
+            if state.pbar: state.pbar.close()
+        if self.bundle:
+            self.bundle.file_done()
+            self._advance(state, 0)
+
+        # a single line, so concurrent bundle downloads do not interleave it
+        if state.size == state.done:
+            print(f'Filesize check: {filename}: expected: {state.size}; actual: {state.done} Succeeded.')
+            state.catch_up(state.size)
+            record = {
+                'url': self.uri,
+                'password': self.key,
+                'file_id': file_id,
+                'name': web_name,
+                'path': os.path.abspath(final_path),
+                'size': state.size,
+                'sha256': state.hasher.hexdigest(),
+                'started': started_at.isoformat(timespec='seconds'),
+                'seconds': round(time.monotonic() - started, 3),
+            }
+            # the extractor still reads the .dl file
+            extracted_to = extractor.finish() if extractor else None
+            if extractor and extracted_to is None:
+                print(f"Could not extract {filename} while downloading ({extractor.error}).")
+            # 一時ファイルを最終ファイル名にリネーム
+            rename(temp, final_path)
+            filename = final_path
+            if extracted_to is None and archive_kind(final_path.name):
+                extracted_to = self._extract(final_path, uploads_dir, state)
+            if extracted_to is not None:
+                print(f"Extracted {filename} to {extracted_to}.")
+                try:
+                    Path(filename).unlink()
+                    print(f"Deleted archive file: {filename}")
+                except Exception as e:
+                    print(f"Failed to delete archive file: {e}")
+            record['extracted_to'] = str(extracted_to) if extracted_to is not None else None
+            with self._dl_lock:
+                self.records.append(record)
+        else:
+            if extractor:
+                extractor.abort()
+                extractor.finish()
+            if self.download_stopped:
+                # the segment map is kept, so the next run continues from here
+                print(f'Stopped {filename} at {bytes_to_size_str(state.done)} of {bytes_to_size_str(state.size)}: {temp}')
+                return filename
+            print(f'Filesize check: {filename}: expected: {state.size}; actual: {state.done}')
+            print(f"Downloaded file is corrupt. Please check the broken file at {temp} and delete it yourself if needed.")
+        return filename
 
-        files_info = []
 
+    def _parse_page_soup(self, text, page_id):
+        """The BeautifulSoup parse of the page, for when parse_download_page doesn't recognise it."""
+        files_info = []
         try:
-            soup = BeautifulSoup(r.text, 'html.parser')
-            if soup.select_one('#contents_matomete'):
-                print('Matomete mode. Files will be downloaded one by one.')
+            soup = BeautifulSoup(text, 'html.parser')
+            self.matomete = soup.select_one('#contents_matomete') is not None
+            if self.matomete:
                 for ele in soup.select('.matomete_file'):
                     web_name = ele.select_one('.matomete_file_info > span:nth-child(2)').text.strip()
                     file_id = re.search(r'download\(\d+, *\'(.+?)\'', ele.select_one('.download_panel_btn_dl')['onclick'])[1]
                     size_str = re.search(r'（(.+?)）', ele.select_one('.matomete_file_info > span:nth-child(3)').text.strip())[1]
                     files_info.append((web_name, size_str, file_id))
             else:
-                file_id = m[1]
+                file_id = page_id
                 size_str = soup.select_one('.dl_size').text.strip()
                 web_name = soup.select_one('#dl').text.strip()
                 files_info.append((web_name, size_str, file_id))
         except Exception as ex:
-            print(f'ERROR! Failed to parse the page {self.uri}.')
-            print(ex)
-            print('Please report it back to the developer.')
-            return
+            raise ValueError(f'ERROR! Failed to parse the page {self.uri}. ({ex})') from ex
+        return files_info
+
+
+    def resolve(self):
+        """Fetch and parse the page (which also sets up the cookie) and return its files.
+
+        ``self.files`` becomes a list of (name, size as shown, file id).
+        Raises ValueError for an invalid URL, or a page without files
+        (expired or deleted), and when the page's password is refused.
+        """
+        m = re.search(r'^https?:\/\/\d+?\.gigafile\.nu\/([a-z0-9-]+)$', self.uri)
+        if not m:
+            raise ValueError('Invalid URL.')
+        cached = self.page_cache.lookup(self.uri, self.key) if self.page_cache else None
+        if cached is not None:
+            self.matomete, self.files, cookies = cached
+            self.session.cookies.update(cookies)
+            self.cached_page = True
+            return self.files
+        r = self.session.get(self.uri) # setup cookie
+
+        parsed = parse_download_page(r.text, m[1])
+        if parsed is not None:
+            self.matomete, files_info = parsed
+        else:
+            files_info = self._parse_page_soup(r.text, m[1])
+        if not files_info:
+            raise ValueError(f'No files found in the page {self.uri}.')
+
+        if self.key and not self.aria2:
+            # a refused password gets an HTML page instead of the file
+            web_name, _, file_id = files_info[0]
+            url = self.uri.rsplit('/', 1)[0] + f'/download.php?file={file_id}&dlkey={self.key}'
+            with self.session.get(url, stream=True, headers={'Range': 'bytes=0-0'}) as probe:
+                content_type = probe.headers.get('Content-Type', '')
+            if content_type.startswith('text/html') and not web_name.lower().endswith(('.htm', '.html')):
+                raise ValueError(f'The password for {self.uri} was refused.')
+
+        if self.page_cache:
+            self.page_cache.store(self.uri, self.key, self.matomete, files_info,
+                                  requests.utils.dict_from_cookiejar(self.session.cookies))
+        self.cached_page = False
+        self.files = files_info
+        return files_info
+
+
+    def _refresh_page(self):
+        """Fetch the page (and its cookie) again after download.php answered with a page instead of a file."""
+        with self._dl_lock:
+            # once for all files of a bundle; a file refused again after that fails
+            if not self.page_refreshed:
+                self.page_refreshed = True
+                if self.cached_page:
+                    self.page_cache.forget(self.uri, self.key)
+                self.resolve()
+
+
+    def download(self, odir=None, only=None):
+        """Download the file(s) of the page into ``odir``; ``only`` limits it to a set of file ids."""
+        output = None
+        if self.files is None:
+            try:
+                self.resolve()
+            except ValueError as ex:
+                print(ex)
+                if isinstance(ex.__cause__, Exception):
+                    print('Please report it back to the developer.')
+                return
+        files_info = self.files
+        if self.matomete:
+            print('Matomete mode.')
+
+        if only is not None:
+            files_info = [info for info in files_info if info[2] in only]
 
         downloaded = []
+        self.retry = RetryPolicy()
+        self.records = []
+        # download_stopped is only cleared in __init__, so a stop requested before this call still holds
+        if self.download_stopped:
+            return downloaded
 
         if len(files_info) > 1:
             print(f'Found {len(files_info)} files in the page.')
 
+        if len(files_info) > 1 and self.bundle_jobs > 1 and not self.aria2:
+            return self._download_bundle(odir, output, files_info)
         for idx, (web_name, size_str, file_id) in enumerate(files_info, 1):
-            print(f'Name: {web_name}, size: {size_str}, id: {file_id}')
-            # only sanitize web filename. User provided output string(s) are on their own.
-            if not output:
-                filename = re.sub(r'[\\/:*?"<>|]', '_', web_name)
-            else:
-                if len(files_info) > 1:
-                    # if there are more than one files, append idx to the filename
-                    filename = output + f'_{idx}'
-                else:
-                    filename = output
-
-            download_url = self.uri.rsplit('/', 1)[0] + '/download.php?file=' + file_id
-            if self.key:
-                download_url += f'&dlkey={self.key}'
-            if self.aria2:
-                cookie_str = "; ".join([f"{cookie.name}={cookie.value}" for cookie in self.session.cookies])
-                cmd = ['aria2c', download_url, '--header', f'Cookie: {cookie_str}', '-o', filename]
-                cmd.extend(self.aria2.split(' '))
-                run(cmd)
-                continue
+            filename = self._download_one(odir, output, idx, len(files_info), web_name, size_str, file_id)
+            if self.retry.retries:
+                print(self.retry.summary())
+            if filename is not None:
+                downloaded.append(filename)
+            if self.download_stopped:
+                break
+        return downloaded
 
-            # 出力ディレクトリを確保
-            uploads_dir = Path(odir) if odir else Path('./uploads')
-            uploads_dir.mkdir(exist_ok=True)
-            
-            # 一時ファイルと最終ファイルパスを出力ディレクトリ内に設定
-            final_path = uploads_dir / filename
-            temp = str(final_path) + '.dl'
-            
-            with self.session.get(download_url, stream=True) as r:
-                r.raise_for_status()
-                filesize = int(r.headers['Content-Length'])
-                downloaded_size = 0
-                
-                # GUI進捗コールバックでファイル名とサイズを通知（ダウンロード開始時）
-                if self.progress_callback:
-                    self.progress_callback(0, web_name, 0, filesize)
-                
-                if self.progress:
-                    desc = filename if len(filename) <= 20 else filename[0:11] + '..' + filename[-7:]
-                    self.pbar = tqdm(total=filesize, unit='B', unit_scale=True, unit_divisor=1024, desc=desc)
-                
-                with open(temp, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=self.chunk_copy_size):
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
-                        
-                        # プログレスバー更新
-                        if self.pbar: 
-                            self.pbar.update(len(chunk))
-                        
-                        # GUI進捗コールバック実行（ファイル名、ダウンロードサイズ、合計サイズ付き）
-                        if self.progress_callback:
-                            progress_percent = int((downloaded_size / filesize) * 100) if filesize > 0 else 0
-                            result = self.progress_callback(progress_percent, web_name, downloaded_size, filesize)
-                            # コールバックがFalseを返した場合（停止要求）
-                            if result is False:
-                                break
-                            
-            if self.pbar: self.pbar.close()
-
-            filesize_downloaded = Path(temp).stat().st_size
-            print(f'Filesize check: expected: {filesize}; actual: {filesize_downloaded}', end=' ')
-            if filesize == filesize_downloaded:
-                print("Succeeded.")
-                # 一時ファイルを最終ファイル名にリネーム
-                rename(temp, final_path)
-                filename = final_path
-                ext = Path(filename).suffix.lower()
-                if ext in ['.zip', '.7z', '.gz', '.tar']:
-
-                    def try_extract(cmd, timeout=30):
+
+    def _download_bundle(self, odir, output, files_info):
+        """Download the files of a matomete page ``self.bundle_jobs`` at a time over the shared session.
+
+        Returns the paths in page order. A file that fails is reported and
+        skipped; if none could be downloaded the first error is raised.
+        """
+        jobs = min(self.bundle_jobs, len(files_info))
+        print(f'Downloading {jobs} files at a time.')
+        # a batch-wide bundle set by the caller already counts these files
+        own = self.bundle is None
+        pbar = None
+        if own:
+            if self.progress:
+                pbar = tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024, desc='total')
+            self.bundle = BundleProgress(len(files_info), pbar, sum(page_size_to_bytes(info[1]) for info in files_info))
+        results = [None] * len(files_info)
+        errors = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+                futures = {ex.submit(self._download_one, odir, output, idx, len(files_info), *info): idx
+                           for idx, info in enumerate(files_info, 1)}
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        idx = futures[future]
                         try:
-                            print(f"Running command: {' '.join(map(str, cmd))}")
-                            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
-                            return result.returncode == 0
+                            results[idx - 1] = future.result()
                         except Exception as e:
-                            print(f"Extraction failed: {e}")
-                            return False
-
-                    extracted = False
-                    extract_dir = uploads_dir
-                    if ext == '.zip' or ext == '.7z' or ext == '.gz' or ext == '.tar':
-                        # Try to extract using unar first (unar supports zip, 7z, tar, gz)
-                        print(f"Trying to extract {filename} with unar...")
-                        cmd = ['unar', '-o', str(extract_dir), filename]
-                        result = try_extract(cmd)
-                        if result is not False:
-                            print(f"Extracted {filename} with unar.")
-                            try:
-                                Path(filename).unlink()
-                                print(f"Deleted archive file: {filename}")
-                            except Exception as e:
-                                print(f"Failed to delete archive file: {e}")
-                            extracted = True
-                        if not extracted:
-                            print(f"Failed to extract {filename} with unar.")
-            else:
-                print(f"Downloaded file is corrupt. Please check the broken file at {temp} and delete it yourself if needed.")
-            downloaded.append(filename)
+                            print(f'Failed to download {files_info[idx - 1][0]}: {e}')
+                            errors.append(e)
+                except BaseException:
+                    # stop the other files at their next chunk
+                    self.download_stopped = True
+                    raise
+        finally:
+            if own:
+                if pbar is not None: pbar.close()
+                self.bundle = None
+        if self.retry.retries:
+            print(self.retry.summary())
+        downloaded = [filename for filename in results if filename is not None]
+        if errors and not downloaded:
+            raise errors[0]
         return downloaded
 
+
 class GigaFileManager:
     def __init__(self, root):
         self.root = root
@@ -420,6 +2722,10 @@ class GigaFileManager:
         # アクティブな処理
         self.active_downloads = {}
         self.active_uploads = {}
+        self.upload_scheduler = None
+        # 共有スケジューラを使うまだ終わっていないアップロードの数
+        self.upload_pending = 0
+        self.upload_pending_lock = threading.Lock()
         
         # 停止フラグ
         self.stop_downloads = False
@@ -431,6 +2737,20 @@ class GigaFileManager:
         self.setup_ui()
         self.check_progress()
         
+        # 期限切れのページ・アップロードキャッシュを起動時に整理（UIを止めないよう別スレッドで）
+        threading.Thread(target=self.prune_caches, daemon=True).start()
+        
+    def prune_caches(self):
+        """PageCache と UploadCache から期限切れのエントリを削除"""
+        try:
+            pages = PageCache().prune()
+            uploads = UploadCache().prune()
+        except (OSError, sqlite3.Error) as e:
+            self.progress_queue.put(("log", f"キャッシュの整理に失敗しました: {e}"))
+            return
+        if pages or uploads:
+            self.progress_queue.put(("log", f"期限切れのキャッシュを削除しました（ページ {pages}件、アップロード {uploads}件）"))
+        
     def setup_ui(self):
         # メインフレーム
         main_frame = ttk.Frame(self.root, padding="10")
@@ -480,9 +2800,23 @@ class GigaFileManager:
         self.url_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         url_scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
         
+        # ダウンロード設定フレーム
+        download_settings_frame = ttk.LabelFrame(self.download_frame, text="ダウンロード設定", padding="5")
+        download_settings_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(0, 10))
+        
+        # 分割ダウンロード設定（Range非対応のサーバーでは1接続で取得）
+        self.download_connections = tk.IntVar(value=1)
+        ttk.Label(download_settings_frame, text="1ファイルあたりの同時接続数:").grid(row=0, column=0, sticky=tk.W, padx=(0, 5))
+        ttk.Spinbox(download_settings_frame, from_=1, to=16, textvariable=self.download_connections, width=5).grid(row=0, column=1, sticky=tk.W)
+
+        # まとめページのファイルを同時にダウンロードする数
+        self.bundle_jobs = tk.IntVar(value=4)
+        ttk.Label(download_settings_frame, text="まとめページの同時ダウンロード数:").grid(row=0, column=2, sticky=tk.W, padx=(20, 5))
+        ttk.Spinbox(download_settings_frame, from_=1, to=16, textvariable=self.bundle_jobs, width=5).grid(row=0, column=3, sticky=tk.W)
+
         # ダウンロードボタンフレーム
         dl_button_frame = ttk.Frame(self.download_frame)
-        dl_button_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 10))
+        dl_button_frame.grid(row=3, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 10))
         
         self.download_button = ttk.Button(dl_button_frame, text="ダウンロード開始", command=self.start_downloads)
         self.download_button.grid(row=0, column=0, padx=(0, 5))
@@ -493,7 +2827,8 @@ class GigaFileManager:
         # グリッド設定
         self.download_frame.columnconfigure(0, weight=1)
         self.download_frame.rowconfigure(1, weight=1)
-        self.download_frame.rowconfigure(2, weight=0)  # ボタンフレームは固定サイズ
+        self.download_frame.rowconfigure(2, weight=0)  # 設定フレームは固定サイズ
+        self.download_frame.rowconfigure(3, weight=0)  # ボタンフレームは固定サイズ
         dl_dir_frame.columnconfigure(0, weight=1)
         url_frame.columnconfigure(0, weight=1)
         url_frame.rowconfigure(0, weight=1)
@@ -538,6 +2873,14 @@ class GigaFileManager:
         self.auto_zip = tk.BooleanVar(value=True)
         ttk.Checkbutton(upload_settings_frame, text="複数ファイル時に自動ZIP化", variable=self.auto_zip).grid(row=0, column=0, sticky=tk.W)
         
+        # 再開設定
+        self.resume_upload = tk.BooleanVar(value=True)
+        ttk.Checkbutton(upload_settings_frame, text="中断したアップロードを再開", variable=self.resume_upload).grid(row=1, column=0, sticky=tk.W)
+        
+        # キャッシュ設定
+        self.reuse_uploads = tk.BooleanVar(value=True)
+        ttk.Checkbutton(upload_settings_frame, text="同じ内容のファイルは前回のリンクを再利用", variable=self.reuse_uploads).grid(row=2, column=0, sticky=tk.W)
+        
         # アップロードボタンフレーム
         ul_button_frame = ttk.Frame(self.upload_frame)
         ul_button_frame.grid(row=3, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 10))
@@ -609,6 +2952,18 @@ class GigaFileManager:
         self.log_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         log_scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
         
+        # 帯域制限フレーム（転送中でも「適用」で即座に反映）
+        limit_frame = ttk.LabelFrame(common_frame, text="帯域制限（例: 50M、空欄で無制限）", padding="5")
+        limit_frame.grid(row=2, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 0))
+        
+        self.upload_limit = tk.StringVar()
+        self.download_limit = tk.StringVar()
+        ttk.Label(limit_frame, text="アップロード上限 (/s):").grid(row=0, column=0, padx=(0, 5))
+        ttk.Entry(limit_frame, textvariable=self.upload_limit, width=10).grid(row=0, column=1, padx=(0, 15))
+        ttk.Label(limit_frame, text="ダウンロード上限 (/s):").grid(row=0, column=2, padx=(0, 5))
+        ttk.Entry(limit_frame, textvariable=self.download_limit, width=10).grid(row=0, column=3, padx=(0, 15))
+        ttk.Button(limit_frame, text="適用", command=self.apply_rate_limits).grid(row=0, column=4)
+        
         # 共通フレームのグリッド設定
         self.root.columnconfigure(0, weight=1)
         self.root.rowconfigure(0, weight=2)  # メインフレームを大きく
@@ -621,6 +2976,21 @@ class GigaFileManager:
         log_frame.columnconfigure(0, weight=1)
         log_frame.rowconfigure(0, weight=1)
         
+    def apply_rate_limits(self):
+        limits = []
+        for limiter, var, label in ((UPLOAD_LIMITER, self.upload_limit, "アップロード"),
+                                    (DOWNLOAD_LIMITER, self.download_limit, "ダウンロード")):
+            value = var.get().strip()
+            try:
+                rate = size_str_to_bytes(value) if value else 0
+            except AssertionError:
+                messagebox.showerror("エラー", f"{label}上限の形式が正しくありません: {value}")
+                return
+            limits.append((limiter, rate, label))
+        for limiter, rate, label in limits:
+            limiter.set_rate(rate)
+            self.log_message(f"{label}帯域制限: {bytes_to_size_str(rate) + '/s' if rate else '無制限'}")
+        
     def switch_mode(self):
         if self.current_mode.get() == "download":
             self.download_frame.grid()
@@ -773,11 +3143,14 @@ class GigaFileManager:
         self.download_button.config(state="disabled")
         self.stop_downloads = False
         self.log_message(f"{len(urls)}個のURLのダウンロードを開始します...")
+        # Tkの変数はメインスレッドで読み、ワーカーには値で渡す
+        connections = self.download_connections.get()
+        bundle_jobs = self.bundle_jobs.get()
         
         for url_data in urls:
             if self.stop_downloads:
                 break
-            self.start_single_download(url_data, download_dir)
+            self.start_single_download(url_data, download_dir, connections, bundle_jobs)
             
     def start_uploads(self):
         files = list(self.file_listbox.get(0, tk.END))
@@ -800,23 +3173,37 @@ class GigaFileManager:
                 
         self.upload_button.config(state="disabled")
         self.stop_uploads = False
+        # Tkの変数はメインスレッドで読み、ワーカーには値で渡す
+        resume = self.resume_upload.get()
+        reuse = self.reuse_uploads.get()
         
-        # 複数ファイルかつZIP化オプションが有効な場合
+        # 複数ファイルかつZIP化オプションが有効な場合（一時ファイルを作らずZIP化しながらアップロード）
         if len(valid_files) > 1 and self.auto_zip.get():
-            self.log_message(f"{len(valid_files)}個のファイルをZIP化してアップロードします...")
-            zip_file_path = self.create_zip_file(valid_files)
-            if zip_file_path and not self.stop_uploads:
-                self.start_single_upload(zip_file_path, is_temp_file=True)
-            else:
-                self.upload_button.config(state="normal")
+            self.log_message(f"{len(valid_files)}個のファイルをZIP化しながらアップロードします...")
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            self.start_single_upload(f"files_{timestamp}.zip", archive_files=valid_files, resume=resume, reuse=reuse)
         else:
             self.log_message(f"{len(valid_files)}個のファイルのアップロードを開始します...")
+            scheduler = None
+            if len(valid_files) > 1:
+                # 全ファイルで並列チャンク数の上限を共有し、大きいファイルから順に開始する
+                scheduler = UploadScheduler(4, total=sum(os.path.getsize(path) for path in valid_files))
+                valid_files.sort(key=os.path.getsize, reverse=True)
+            self.upload_scheduler = scheduler
+            if scheduler:
+                # スレッド開始前に件数を確定（先に終わったファイルがスケジューラを閉じないように）
+                with self.upload_pending_lock:
+                    self.upload_pending = len(valid_files)
+            started = 0
             for file_path in valid_files:
                 if self.stop_uploads:
                     break
-                self.start_single_upload(file_path)
+                self.start_single_upload(file_path, scheduler=scheduler, resume=resume, reuse=reuse)
+                started += 1
+            if scheduler and started < len(valid_files):
+                self.finish_scheduled_upload(scheduler, len(valid_files) - started)
             
-    def start_single_download(self, url_data, download_dir):
+    def start_single_download(self, url_data, download_dir, connections=1, bundle_jobs=4):
         url, password = url_data
         display_text = f"{url} [PW]" if password else url
         
@@ -824,57 +3211,26 @@ class GigaFileManager:
         item_id = self.progress_tree.insert("", "end", values=("ダウンロード", display_text, "準備中", "0%", "", ""))
         
         # ダウンロードスレッド開始
-        thread = threading.Thread(target=self.download_worker, args=(url, password, download_dir, item_id))
+        thread = threading.Thread(target=self.download_worker, args=(url, password, download_dir, item_id, connections, bundle_jobs))
         thread.daemon = True
         thread.start()
         
         self.active_downloads[item_id] = thread
         
-    def create_zip_file(self, file_paths):
-        try:
-            # 一時ファイルを作成（アプリバンドル内では書き込み可能なディレクトリを使用）
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            zip_filename = f"files_{timestamp}.zip"
-            
-            # 書き込み可能なディレクトリを取得
-            if getattr(sys, 'frozen', False):
-                # アプリバンドル環境の場合
-                temp_dir = tempfile.gettempdir()
-            else:
-                # 通常の実行環境
-                temp_dir = tempfile.gettempdir()
-            
-            zip_path = os.path.join(temp_dir, zip_filename)
-            
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for file_path in file_paths:
-                    if os.path.isfile(file_path):
-                        # ファイル名のみをアーカイブ内のパスとして使用
-                        arcname = os.path.basename(file_path)
-                        zipf.write(file_path, arcname)
-                        
-            self.log_message(f"ZIP化完了: {zip_filename}")
-            return zip_path
-            
-        except Exception as e:
-            self.log_message(f"ZIP化エラー: {str(e)}")
-            messagebox.showerror("エラー", f"ZIP化に失敗しました: {str(e)}")
-            return None
-            
-    def start_single_upload(self, file_path, is_temp_file=False):
+    def start_single_upload(self, file_path, archive_files=None, scheduler=None, resume=True, reuse=True):
         filename = os.path.basename(file_path)
         
         # プログレステーブルにエントリ追加
         item_id = self.progress_tree.insert("", "end", values=("アップロード", filename, "準備中", "0%", "", ""))
         
         # アップロードスレッド開始
-        thread = threading.Thread(target=self.upload_worker, args=(file_path, item_id, is_temp_file))
+        thread = threading.Thread(target=self.upload_worker, args=(file_path, item_id, archive_files, scheduler, resume, reuse))
         thread.daemon = True
         thread.start()
         
         self.active_uploads[item_id] = thread
         
-    def download_worker(self, url, password, download_dir, item_id):
+    def download_worker(self, url, password, download_dir, item_id, connections=1, bundle_jobs=4):
         try:
             # 停止チェック
             if self.stop_downloads:
@@ -905,7 +3261,7 @@ class GigaFileManager:
             last_status_text = "進行中"
             
             # プログレス更新用コールバック関数（速度計算付き）
-            def progress_callback(percent, current_filename=None, downloaded_size=0, total_size=0):
+            def progress_callback(percent, current_filename=None, downloaded_size=0, total_size=0, bundle=None, extracting=False):
                 nonlocal speed_samples, last_update_time, last_downloaded_size, last_display_update_time, last_status_text
                 
                 # 停止チェック
@@ -913,6 +3269,15 @@ class GigaFileManager:
                     return False  # ダウンロード停止シグナル
                 
                 filename_display = current_filename if current_filename else display_text
+                if extracting:
+                    # 展開の進捗（サイズは展開済みバイト数）
+                    self.progress_queue.put(("update", item_id, "ダウンロード", filename_display, "展開中", f"{percent}%", bytes_to_size_str(total_size) if total_size > 0 else "", ""))
+                    return True
+                if bundle:
+                    # まとめページを同時ダウンロード中はページ全体の合計で表示
+                    downloaded_size, total_size, files_done, files = bundle
+                    percent = int(downloaded_size / total_size * 100) if total_size > 0 else 0
+                    filename_display = f"{display_text} [{files_done}/{files}]"
                 current_time = time.time()
                 
                 # 速度計算（1秒以上経過した場合のみ）
@@ -949,12 +3314,16 @@ class GigaFileManager:
                 return True  # 継続シグナル
             
             # GFileインスタンス作成（パスワードがある場合はkeyパラメータに渡す）
-            gfile = GFile(url, progress=False, mute=True, key=password, progress_callback=progress_callback)
+            gfile = GFile(url, progress=False, mute=True, key=password, progress_callback=progress_callback,
+                          connections=connections, bundle_jobs=bundle_jobs,
+                          page_cache=PageCache())
             
             self.progress_queue.put(("update", item_id, "ダウンロード", display_text, "進行中", "0%", "", ""))
             
             # ファイルIDディレクトリにダウンロード実行
             downloaded_files = gfile.download(odir=file_id_dir)
+            if gfile.retry.retries:
+                self.progress_queue.put(("log", f"{url}: {gfile.retry.summary()}"))
             
             # 停止チェック
             if self.stop_downloads:
@@ -986,7 +3355,18 @@ class GigaFileManager:
             if not self.active_downloads:
                 self.progress_queue.put(("enable_download_button",))
                 
-    def upload_worker(self, file_path, item_id, is_temp_file=False):
+    def finish_scheduled_upload(self, scheduler, count=1):
+        """共有スケジューラのアップロードが ``count`` 件終わった。最後の1件ならスケジューラを閉じる"""
+        with self.upload_pending_lock:
+            self.upload_pending -= count
+            last = self.upload_pending == 0
+        if last and scheduler is self.upload_scheduler:
+            self.upload_scheduler = None
+            scheduler.close()
+            self.progress_queue.put(("log", f"合計スループット: {scheduler.summary()}"))
+        
+    def upload_worker(self, file_path, item_id, archive_files=None, scheduler=None, resume=True, reuse=True):
+        file_slot = False
         try:
             # 停止チェック
             if self.stop_uploads:
@@ -994,7 +3374,10 @@ class GigaFileManager:
                 return
                 
             filename = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
+            if archive_files:
+                file_size = sum(os.path.getsize(path) for path in archive_files)
+            else:
+                file_size = os.path.getsize(file_path)
             file_size_str = bytes_to_size_str(file_size)
             
             self.progress_queue.put(("update", item_id, "アップロード", filename, "開始", "0%", file_size_str, ""))
@@ -1012,7 +3395,7 @@ class GigaFileManager:
             last_status_text = "進行中"
             
             # プログレス更新用コールバック関数（アップロード用）
-            def upload_progress_callback(percent, uploaded_size=0, total_size=0):
+            def upload_progress_callback(percent, uploaded_size=0, total_size=0, window=None):
                 nonlocal speed_samples, last_update_time, last_uploaded_size, last_display_update_time, last_status_text
                 
                 # 停止チェック
@@ -1038,7 +3421,7 @@ class GigaFileManager:
                     eta_secs = int(eta_seconds % 60)
                     eta_str = f"{eta_hours:02d}:{eta_minutes:02d}:{eta_secs:02d}"
                     
-                    last_status_text = f"進行中 ({bytes_to_size_str(avg_speed)}/s, ETA {eta_str})"
+                    last_status_text = f"進行中 ({bytes_to_size_str(avg_speed)}/s, ETA {eta_str}, 並列 {window})"
                     
                     last_update_time = current_time
                     last_uploaded_size = uploaded_size
@@ -1051,13 +3434,33 @@ class GigaFileManager:
                 
                 return True  # 継続シグナル
             
+            # 共有スケジューラ使用時は同時にアップロードするファイル数を制限
+            readahead_memory = '512M'
+            if scheduler:
+                self.progress_queue.put(("update", item_id, "アップロード", filename, "待機中", "0%", file_size_str, ""))
+                scheduler.files.acquire()
+                file_slot = True
+                if self.stop_uploads:
+                    self.progress_queue.put(("update", item_id, "アップロード", "停止", "キャンセル", "0%", file_size_str, ""))
+                    return
+                readahead_memory = size_str_to_bytes(readahead_memory) // scheduler.file_limit
+            
             # GFileインスタンス作成（アップロード用、進捗コールバック付き）
-            gfile = GFile(file_path, progress=False, mute=True, progress_callback=upload_progress_callback)
+            gfile = GFile(file_path, progress=False, mute=True, progress_callback=upload_progress_callback,
+                          readahead_memory=readahead_memory, scheduler=scheduler,
+                          cache=UploadCache() if reuse else None)
             
             self.progress_queue.put(("update", item_id, "アップロード", filename, "進行中", "0%", file_size_str, ""))
             
             # アップロード実行
-            result = gfile.upload()
+            if archive_files:
+                result = gfile.upload_stream(
+                    functools.partial(write_zip, archive_files, report=lambda message: self.progress_queue.put(("log", message))),
+                    size_hint=file_size)
+            else:
+                result = gfile.upload(resume=resume)
+            if gfile.retry.retries:
+                self.progress_queue.put(("log", f"{filename}: {gfile.retry.summary()}"))
             
             # 停止チェック
             if self.stop_uploads:
@@ -1084,16 +3487,12 @@ class GigaFileManager:
             self.progress_queue.put(("update", item_id, "アップロード", "エラー", "失敗", "0%", file_size_str, ""))
             self.progress_queue.put(("log", f"アップロードエラー: {filename} - {str(e)}"))
         finally:
-            # 一時ファイルの場合は削除
-            if is_temp_file and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    self.progress_queue.put(("log", f"一時ファイルを削除: {filename}"))
-                except Exception as e:
-                    self.progress_queue.put(("log", f"一時ファイル削除エラー: {filename} - {str(e)}"))
-                    
+            if file_slot:
+                scheduler.files.release()
             if item_id in self.active_uploads:
                 del self.active_uploads[item_id]
+            if scheduler:
+                self.finish_scheduled_upload(scheduler)
             
             # すべてのアップロードが完了したらボタンを有効化
             if not self.active_uploads:
@@ -1108,6 +3507,8 @@ class GigaFileManager:
         
     def stop_all_uploads(self):
         self.stop_uploads = True
+        if self.upload_scheduler:
+            self.upload_scheduler.cancel()
         self.log_message("アップロード停止が要求されました。")
         
         # ボタンを有効化
@@ -1149,4 +3550,7 @@ def main():
     root.mainloop()
 
 if __name__ == "__main__":
+    # PyInstaller環境でのmultiprocessing対応
+    if getattr(sys, 'frozen', False):
+        multiprocessing.freeze_support()
     main()
@@ -0,0 +1,33 @@
+"""Shared pieces of the tests: a requests adapter that sends gigafile.nu's URLs to a local stand-in server."""
+import sys
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    """Sends every https:// request to the stand-in on ``port`` over plain HTTP."""
+
+    def __init__(self, port, max_retries=0):
+        super().__init__(pool_maxsize=32, max_retries=max_retries)
+        self.port = port
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = f'http://127.0.0.1:{self.port}{url.path}' + (f'?{url.query}' if url.query else '')
+        return super().send(request, **kwargs)
+
+
+def mount_local(session, port):
+    """Route ``session``'s https:// requests to the stand-in, keeping the retries of the adapter it had."""
+    session.mount('https://', LocalAdapter(port, session.get_adapter('https://').max_retries))
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    # upload journals and caches go here instead of the home directory
+    monkeypatch.setenv('GIGAFILE_STATE_DIR', str(tmp_path / 'state'))
@@ -0,0 +1,109 @@
+"""The threaded download path against a local stand-in: connection reuse, and one layer of retries.
+
+    python -m pytest tests
+"""
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+from conftest import mount_local
+import gigafilecli
+from gigafilecli import GFile
+
+FILES = {f'id{i}': os.urandom(100_000 + i) for i in range(20)}
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """A matomete page of FILES and download.php, counting connections and requests."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _reply(self, status, body, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        url = urlsplit(self.path)
+        if url.path == '/download.php' and self.server.fail_status:
+            with self.server.lock:
+                self.server.failed += 1
+            return self._reply(self.server.fail_status, b'', {'Content-Type': 'text/plain'})
+        if url.path != '/download.php':
+            page = '<div id="contents_matomete">' + ''.join(
+                f'<div class="matomete_file"><div class="matomete_file_info"><span>x</span><span>{file_id}.bin</span>'
+                f'<span>（100KB）</span></div><button class="download_panel_btn_dl" onclick="download(1, \'{file_id}\')"></button></div>'
+                for file_id in FILES) + '</div>'
+            return self._reply(200, page.encode(), {'Content-Type': 'text/html; charset=utf-8'})
+        data = FILES[parse_qs(url.query)['file'][0]]
+        if 'Range' in self.headers:
+            start, _, end = self.headers['Range'][6:].partition('-')
+            start, stop = int(start), int(end) + 1 if end else len(data)
+            return self._reply(206, data[start:stop], {'Content-Type': 'application/octet-stream',
+                                                       'Content-Range': f'bytes {start}-{stop - 1}/{len(data)}'})
+        self._reply(200, data, {'Content-Type': 'application/octet-stream'})
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    httpd.daemon_threads = True
+    httpd.lock = threading.Lock()
+    httpd.connections = 0
+    httpd.requests = 0
+    httpd.fail_status = None
+    httpd.failed = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize('connections', [1, 2])
+def test_bundle_reuses_pooled_connections(server, tmp_path, connections):
+    bundle_jobs = 4
+    gfile = GFile('https://46.gigafile.nu/0101-bundle', bundle_jobs=bundle_jobs, connections=connections, mute=True)
+    mount_local(gfile.session, server.server_port)
+
+    paths = gfile.download(odir=str(tmp_path))
+
+    assert sorted(path.name for path in paths) == sorted(f'{file_id}.bin' for file_id in FILES)
+    for file_id, data in FILES.items():
+        assert (tmp_path / f'{file_id}.bin').read_bytes() == data
+    assert server.requests > len(FILES)
+    # one connection per file slot and segment at most, plus the one of the page
+    assert server.connections <= bundle_jobs * connections + 1
+
+
+def test_server_errors_are_retried_by_retry_policy_alone(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(gigafilecli.RetryPolicy, 'delay', lambda self, attempt, response=None: 0.0)
+    server.fail_status = 503
+    gfile = GFile('https://46.gigafile.nu/0101-bundle', bundle_jobs=1, mute=True)
+    mount_local(gfile.session, server.server_port)
+    gfile.resolve()
+    gfile.files = gfile.files[:1]
+
+    with pytest.raises(requests.HTTPError):
+        gfile.download(odir=str(tmp_path))
+
+    # urllib3 does not retry the statuses underneath, so every GET is one RetryPolicy counted
+    assert gfile.retry.retries == gfile.retry.per_chunk
+    assert server.failed == gfile.retry.retries + 1
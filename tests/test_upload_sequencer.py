@@ -0,0 +1,141 @@
+"""ChunkSequencer and the threaded upload path against a local stand-in for the upload server.
+
+    python -m pytest tests
+"""
+import email.parser
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import mount_local
+from gigafilecli import ChunkSequencer, GFile, UploadJournal, file_identity
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """gigafile.nu's front page and upload_chunk.php, answering each chunk after a random delay."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, content_type='application/json'):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(f'<script>var server = "127.0.0.1:{self.server.server_port}";</script>', 'text/html')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        form = email.parser.BytesParser().parsebytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        fields = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True) for part in form.get_payload()}
+        chunk, chunks = int(fields['chunk']), int(fields['chunks'])
+        # so the responses of chunks in flight come back out of order
+        time.sleep(random.random() * 0.005)
+        upload = self.server.uploads
+        with upload['lock']:
+            upload['received'].append(chunk)
+            upload['chunks'][chunk] = fields['file']
+            done = len(upload['chunks']) == chunks
+        if done:
+            content = b''.join(upload['chunks'][i] for i in range(chunks))
+            self._reply(json.dumps({'status': 0, 'url': f'https://46.gigafile.nu/{hashlib.sha256(content).hexdigest()}'}))
+        else:
+            self._reply(json.dumps({'status': 0}))
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    httpd.daemon_threads = True
+    httpd.uploads = {'lock': threading.Lock(), 'received': [], 'chunks': {}}
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_sequencer_advances_in_order():
+    count = 300
+    sequencer = ChunkSequencer()
+    finished = []
+
+    def worker(chunk_no):
+        time.sleep(random.random() * 0.01)
+        assert sequencer.wait_turn(chunk_no)
+        finished.append(chunk_no)
+        sequencer.advance(chunk_no, 10)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in reversed(range(count))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert not any(thread.is_alive() for thread in threads)
+    assert finished == list(range(count))
+    assert sequencer.current == count
+    assert sequencer.acked_bytes == 10 * count
+
+
+def test_sequencer_rejects_out_of_order_and_abort_wakes_waiters():
+    sequencer = ChunkSequencer(start=5)
+    with pytest.raises(RuntimeError):
+        sequencer.advance(6)
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(sequencer.wait_turn(i))) for i in range(6, 20)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    sequencer.abort()
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert results == [False] * len(threads)
+
+
+@pytest.mark.parametrize('readahead', [0, 2])
+def test_upload_of_hundreds_of_chunks(server, tmp_path, readahead):
+    data = os.urandom(400 * 4096 + 123)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    gfile = GFile(str(path), thread_num=8, chunk_size=4096, readahead=readahead, mute=True)
+    mount_local(gfile.session, server.server_port)
+
+    assert gfile.upload() is gfile
+    assert not gfile.failed
+
+    chunks = 401
+    received = server.uploads['received']
+    # every chunk sent once, and the cursor moved once per chunk
+    assert sorted(received) == list(range(chunks))
+    assert gfile.sequencer.current == chunks
+    assert gfile.sequencer.acked_bytes == len(data)
+    assert gfile.data['url'].endswith(hashlib.sha256(data).hexdigest())
+
+
+def test_journal_without_chunks_left_starts_over(server, tmp_path):
+    data = os.urandom(10 * 4096)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    # every chunk acknowledged, but the run died before the link came back
+    UploadJournal.for_file(path).save(identity=file_identity(str(path)), token='old', server='127.0.0.1:1', cookies={},
+                                      chunk_size=4096, first_size=4096, acked=10)
+    gfile = GFile(str(path), thread_num=4, chunk_size=4096, mute=True)
+    mount_local(gfile.session, server.server_port)
+
+    assert gfile.upload(resume=True) is gfile
+    assert sorted(server.uploads['received']) == list(range(10))
+    assert gfile.data['url'].endswith(hashlib.sha256(data).hexdigest())
+    assert not UploadJournal.for_file(path).path.exists()